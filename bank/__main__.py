@@ -1,6 +1,4 @@
 import os.path
-import yaml
-import json
 import sys
 import logging
 import datetime
@@ -8,30 +6,120 @@ import datetime
 import click
 
 from . import config
+from . import instrument
+from . import output
+from . import summary
 from . import util
 from . import project_name
 from .db import DB
-from .account import Account
 from .tableformatter import TableFormatter
 
 logger = logging.getLogger(__name__)
 default_config_path = os.path.join(os.path.expanduser('~'),
                                    '.config',
                                    project_name + '.yml')
+default_cache_path = os.path.join(os.path.expanduser('~'),
+                                  '.cache',
+                                  project_name)
 
 
 class App(object):
     def __init__(self, config):
         self.sessions = {}
         self.config = config
-        self.db = DB(config.getpath('database', project_name + '.db'))
+        self._accounts = None
+        self.db = DB(config.getpath('database', project_name + '.db'),
+                     config.database_tuning)
+
+    def cache_path(self, *path):
+        directory = self.config.getpath('cache', default_cache_path)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, *path)
 
     @property
     def accounts(self):
-        return tuple(Account(self, id) for id, infos in self.config.accounts)
+        if self._accounts is None:
+            from .account import Account
+            self._accounts = tuple(Account(self, id)
+                                   for id, infos in self.config.accounts)
+        return self._accounts
 
 pass_app = click.make_pass_decorator(App)
 
+format_option = click.option(
+    '--format', '-f', 'output_format',
+    type=click.Choice(output.formats),
+    help='''
+        Output format [default: table when writing to a terminal, tsv
+        otherwise]
+    ''')
+
+
+def print_rows(output_format, formatter, rows):
+    output_format = output_format or output.default_format()
+    if output_format == 'table':
+        formatter.print(rows)
+    else:
+        output.write(output_format, formatter.labels, rows)
+
+
+def start_profile(ctx, mode, path):
+    """Record timers until the command ends, then report them."""
+    instrument.start()
+    profiler = None
+
+    if mode == 'cprofile':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    @ctx.call_on_close
+    def report():
+        if profiler:
+            profiler.disable()
+        recorder = instrument.stop()
+
+        if mode == 'cprofile' and path:
+            profiler.dump_stats(path)
+            return
+
+        fp = open(path, 'w') if path else sys.stderr
+        try:
+            if mode == 'cprofile':
+                import pstats
+                pstats.Stats(profiler, stream=fp) \
+                    .sort_stats('cumulative') \
+                    .print_stats(30)
+
+            elif mode == 'json':
+                import json
+                json.dump(recorder.trace(), fp)
+
+            else:
+                total = recorder.duration
+                f = TableFormatter()
+                f.max_width, _ = click.get_terminal_size()
+                f.add_column('Category')
+                f.add_column('Name')
+                f.add_column('Calls', align='>')
+                f.add_column('Rows', align='>')
+                f.add_column('Time', align='>')
+                f.add_column('%', align='>')
+                f.write((
+                    (timer.category,
+                     timer.name if len(timer.name) <= 80
+                     else timer.name[:77] + '...',
+                     timer.count,
+                     timer.rows,
+                     '{:.1f}ms'.format(timer.duration * 1e3),
+                     '{:.1f}'.format(timer.duration / total * 100))
+                    for timer in recorder.summary()
+                ), fp)
+                fp.write('Total: {:.1f}ms\n'.format(total * 1e3))
+        finally:
+            if path:
+                fp.close()
+
 
 def print_version(ctx, param, value):
     if value and not ctx.resilient_parsing:
@@ -55,8 +143,15 @@ def print_version(ctx, param, value):
                               resolve_path=True),
               default=default_config_path,
               show_default=True)
+@click.option('--profile',
+              type=click.Choice(('summary', 'cprofile', 'json')),
+              help='Profile the command and print a report')
+@click.option('--profile-output',
+              metavar='FILE',
+              type=click.Path(dir_okay=False, writable=True),
+              help='Write the profile report to FILE')
 @click.pass_context
-def main(ctx, verbose, config_path):
+def main(ctx, verbose, config_path, profile, profile_output):
     log_levels = {
         0: logging.ERROR,
         1: logging.INFO,
@@ -64,8 +159,17 @@ def main(ctx, verbose, config_path):
     }
 
     logging.basicConfig(level=log_levels.get(verbose, log_levels[2]))
-    ctx.obj = App(config.from_yaml(config_path, default={}))
-    if not ctx.obj.accounts:
+
+    if profile:
+        start_profile(ctx, profile, profile_output)
+
+    with instrument.span('config', 'from_yaml'):
+        ctx.obj = App(config.from_yaml(
+            config_path,
+            default={},
+            cache_path=os.path.join(default_cache_path, 'config.json')))
+    # Benchmarks use their own accounts
+    if not ctx.obj.accounts and ctx.invoked_subcommand != 'bench':
         click.echo('No account configured')
         sys.exit(1)
 
@@ -104,10 +208,10 @@ def chart(app, delta, since, output=None):
 
     line_chart.title = 'Balance since {}'.format(since)
 
-    for account in accounts:
-        labels, values = util.format_serie(account, since, delta=delta)
+    labels, series = util.format_series(accounts, since, delta=delta)
+    for account, values in zip(accounts, series):
         line_chart.add(account.name, values)
-        line_chart.x_labels = labels
+    line_chart.x_labels = labels
 
     filename = output or '_'.join(a.name for a in accounts) + '.svg'
     line_chart.render_to_file(filename)
@@ -118,42 +222,51 @@ def chart(app, delta, since, output=None):
 @main.command(
     help='Update the database with latest transactions',
 )
+@click.option('--jobs', '-j',
+              metavar='N',
+              help='Number of adaptor sessions to fetch concurrently',
+              type=int,
+              default=1,
+              show_default=True)
 @pass_app
-def update(app):
-
-    for account in app.accounts:
-        click.echo('Udpating account {}'.format(account.name))
-
-        balance_before = account.get_balance()
-        account.update_balance()
-
-        transactions_before = account.transaction_count()
-        account.update_transactions()
-        transactions_after = account.transaction_count()
+def update(app, jobs):
+    from .updater import Updater
 
-        balance_after = account.get_balance()
+    updates = Updater(app.accounts, jobs=jobs, echo=click.echo).run()
 
-        click.echo('Balance diff: {:.2}'
-                   .format(balance_after - balance_before))
+    f = TableFormatter()
+    f.max_width, f.height = click.get_terminal_size()
+    f.add_column('Account')
+    f.add_column('Fetch', align='>')
+    f.add_column('Store', align='>')
+    f.add_column('Total', align='>')
+    f.print(
+        (update.account.name,
+         '{:.2f}s'.format(update.fetch_time),
+         '{:.2f}s'.format(update.store_time),
+         '{:.2f}s'.format(update.total_time))
+        for update in updates
+    )
 
-        click.echo('{} new transactions'
-                   .format(transactions_after - transactions_before))
+    if any(update.error for update in updates):
+        sys.exit(1)
 
 
 @main.command(
     help='Display current account balances',
 )
+@format_option
 @pass_app
-def balances(app):
+def balances(app, output_format):
 
     f = TableFormatter()
     f.max_width, f.height = click.get_terminal_size()
     f.add_column('Account')
     f.add_column('Balance', align='>')
-    f.print(
+    print_rows(output_format, f, (
         (account.name, account.get_balance(datetime.date.today()))
         for account in app.accounts
-    )
+    ))
 
 
 @main.command(
@@ -164,8 +277,9 @@ def balances(app):
               help='outputs the last K transactions',
               type=int,
               default=10)
+@format_option
 @pass_app
-def tail(app, n):
+def tail(app, n, output_format):
 
     f = TableFormatter()
     f.max_width, f.height = click.get_terminal_size()
@@ -183,7 +297,7 @@ def tail(app, n):
     ) ORDER BY date
     ''', (n,))
 
-    f.print(data)
+    print_rows(output_format, f, data)
 
 
 @main.command(
@@ -196,12 +310,101 @@ def tail(app, n):
     help='''
         Displays the total at the end
     ''')
+@click.option(
+    '--limit', '-n',
+    metavar='N',
+    type=int,
+    help='''
+        Displays at most N transactions
+    ''')
+@click.option(
+    '--page', '-p',
+    metavar='P',
+    type=int,
+    help='''
+        Displays the P-th page of N transactions, starting at 1
+    ''')
+@click.option(
+    '--after',
+    metavar='DATE,HASH',
+    type=util.create_cursor,
+    help='''
+        Displays the transactions following this cursor, as printed at the
+        end of a page
+    ''')
+@click.option(
+    '--count-only', '-c',
+    is_flag=True,
+    help='''
+        Only displays the number of matching transactions
+    ''')
+@click.option(
+    '--group-by', '-g',
+    type=click.Choice(sorted(summary.groupings)),
+    help='''
+        Displays aggregates of the matching transactions by account, type
+        or month, instead of the transactions
+    ''')
+@click.option(
+    '--agg', '-a',
+    metavar='AGGREGATES',
+    type=summary.create_aggregates,
+    help='''
+        Comma separated aggregates to display, among sum, count, min, max
+        and avg [default: sum,count]
+    ''')
+@format_option
 @pass_app
-def search(app, query, total):
-
-    from . import ql
-
-    statement, arguments = ql.build(query)
+def search(app, query, total, limit, page, after, count_only, group_by,
+           agg, output_format):
+
+    if limit is not None and limit < 1:
+        raise click.UsageError('--limit must be at least 1')
+
+    if page is not None and (limit is None or page < 1):
+        raise click.UsageError('--page requires --limit and starts at 1')
+
+    if app.config.query_cache:
+        from .qlcache import QueryCache
+        cache = QueryCache(app.cache_path('queries.json'))
+        statement, arguments = cache.build(query)
+        cache.save()
+    else:
+        from . import ql
+        statement, arguments = ql.build(query)
+
+    # Totals are of all the matching transactions, whatever the page
+    total_statement, total_arguments = statement, arguments
+
+    if after:
+        # Keyset pagination: resume right after the last displayed row,
+        # instead of skipping rows with an offset
+        date, hash = after
+        statement = '({}) AND (date > ? OR (date = ? AND hash > ?))' \
+            .format(statement)
+        arguments += (date, date, hash)
+
+    cursor = app.db.cursor()
+
+    if count_only:
+        count, = cursor.execute('''
+            SELECT COUNT(*)
+            FROM "transaction"
+            WHERE {}
+        '''.format(statement), arguments).fetchone()
+        click.echo(count)
+        return
+
+    if group_by or agg:
+        agg = agg or ('sum', 'count')
+        f = TableFormatter()
+        f.max_width, f.height = click.get_terminal_size()
+        f.add_column((group_by or 'transactions').capitalize())
+        for name in agg:
+            f.add_column(name.capitalize(), align='>')
+        print_rows(output_format, f, summary.summarize(
+            cursor, statement, arguments, group_by, agg))
+        return
 
     f = TableFormatter()
     f.max_width, f.height = click.get_terminal_size()
@@ -212,33 +415,43 @@ def search(app, query, total):
     f.add_column('Description')
 
     query = '''
-    SELECT * FROM (
-        SELECT date, account, type, amount, description
-        FROM "transaction"
-        WHERE {}
-        ORDER BY date DESC
-    ) ORDER BY date
+    SELECT date, account, type, amount, description, hash
+    FROM "transaction"
+    WHERE {}
+    ORDER BY date, hash
+    LIMIT ? OFFSET ?
     '''.format(statement)
+    arguments += (-1 if limit is None else limit,
+                  limit * (page - 1) if page else 0)
 
     logger.debug(query)
     logger.debug(repr(arguments))
-    t = 0
-
-    transactions = app.db.cursor().execute(query, arguments)
-
-    def make_total(it):
-        nonlocal t
-        for transaction in it:
-            t += transaction[3]
-            yield transaction
+    if logger.isEnabledFor(logging.DEBUG):
+        for detail in app.db.query_plan(query, arguments):
+            logger.debug('Query plan: %s', detail)
+    count = 0
+    last = None
+
+    def iter_rows(rows):
+        nonlocal count, last
+        for row in rows:
+            count += 1
+            last = row
+            yield row[:5]
+
+    output_format = output_format or output.default_format()
+    print_rows(output_format, f, iter_rows(cursor.execute(query, arguments)))
 
     if total:
-        transactions = make_total(transactions)
-
-    f.print(transactions)
+        # Total of all the matching transactions, not only the displayed ones
+        click.echo('total: {}'.format(
+            summary.total(cursor, total_statement, total_arguments)),
+            err=output_format != 'table')
 
-    if total:
-        print('total: {}'.format(t))
+    if limit is not None and count == limit:
+        click.echo('next page: --after {},{}'.format(last['date'],
+                                                     last['hash']),
+                   err=True)
 
 
 @main.command(
@@ -247,14 +460,221 @@ def search(app, query, total):
         Reindex all transactions from the database. You should not need to use
         this.
     ''')
+@click.option('--since',
+              help='Only reindex transactions since this date',
+              metavar='DATE',
+              type=util.create_date)
 @pass_app
-def reindex(app):
-    app.db.cursor().executescript('''
-    DELETE FROM "transaction_search";
-    INSERT INTO "transaction_search" (docid, account, type, description)
-        SELECT hash, account, type, description
-        FROM "transaction"
+def reindex(app, since):
+    from . import searchindex
+
+    cursor = app.db.cursor()
+    searchindex.reindex(cursor, util.format_date(since) if since else '')
+    searchindex.optimize(cursor)
+    app.db.commit()
+
+
+@main.group(
+    'db',
+    help='''
+        Manage the database schema
+    ''')
+@pass_app
+def db_group(app):
+    app.db.auto_migrate = False
+
+
+@db_group.command(
+    'status',
+    help='''
+        Print the database schema version and pending migrations
+    ''')
+@pass_app
+def db_status(app):
+    click.echo('Schema version: {}'.format(app.db.version))
+    click.echo('Latest version: {}'.format(app.db.latest_version))
+
+    pending = app.db.pending_migrations()
+    if pending:
+        click.echo('Pending migrations:')
+        for migration in pending:
+            click.echo('  {}: {}'.format(migration.version,
+                                         migration.description))
+
+
+@db_group.command(
+    'migrate',
+    help='''
+        Apply pending migrations to the database
+    ''')
+@pass_app
+def db_migrate(app):
+    if not app.db.pending_migrations():
+        click.echo('Database is up to date')
+        return
+
+    app.db.migrate(callback=lambda migration: click.echo(
+        'Migrating to version {}: {}'.format(migration.version,
+                                             migration.description)))
+
+
+@main.command(
+    'bench',
+    short_help='Benchmark bank on synthetic ledgers',
+    help='''
+        Times common operations on synthetic ledgers, which are generated in
+        the cache directory when missing. Results can be saved to a JSON
+        baseline, and compared to a previous one: the command fails if an
+        operation got slower than the baseline by more than the threshold.
     ''')
+@click.option('--size', '-s', 'sizes',
+              multiple=True,
+              type=click.Choice(('10k', '100k', '1m')),
+              help='Number of transactions of a ledger, can be repeated '
+                   '[default: 10k]')
+@click.option('--accounts',
+              type=int,
+              default=4,
+              show_default=True,
+              help='Number of accounts of a ledger')
+@click.option('--repeat', '-r',
+              type=int,
+              default=3,
+              show_default=True,
+              help='Runs of each operation, only the fastest one is kept')
+@click.option('--save',
+              metavar='FILE',
+              type=click.Path(dir_okay=False, writable=True),
+              help='Saves the results as a JSON baseline')
+@click.option('--compare', 'baseline_path',
+              metavar='FILE',
+              type=click.Path(exists=True, dir_okay=False),
+              help='Compares the results to a JSON baseline')
+@click.option('--threshold',
+              type=float,
+              default=1.2,
+              show_default=True,
+              help='Slow down ratio reported as a regression')
+@pass_app
+def bench_command(app, sizes, accounts, repeat, save, baseline_path,
+                  threshold):
+    import collections
+    import tempfile
+    from . import bench
+
+    results = collections.OrderedDict()
+
+    for size in sizes or ('10k',):
+        path = app.cache_path('bench-{}-{}.db'.format(size, accounts))
+        end = bench.ledger_end(path)
+
+        if not os.path.exists(path):
+            click.echo('Generating a ledger of {} transactions'.format(size),
+                       err=True)
+            # Concurrent runs generate their own ledger
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                            suffix='.tmp')
+            os.close(fd)
+            try:
+                ledger_app = App(config.Config(bench.ledger_config(
+                    tmp_path, bench.sizes[size], accounts, end)))
+                bench.create_ledger(ledger_app)
+                ledger_app.db.close()
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+        ledger_app = App(config.Config(bench.ledger_config(
+            path, bench.sizes[size], accounts, end)))
+        results[size] = run_benchmarks(ledger_app, end, repeat)
+        ledger_app.db.close()
+
+    baseline = bench.load_baseline(baseline_path) if baseline_path else {}
+    comparison = tuple(bench.compare(results, baseline, threshold))
+
+    f = TableFormatter()
+    f.add_column('Size')
+    f.add_column('Benchmark')
+    f.add_column('Time', align='>')
+    f.add_column('Baseline', align='>')
+    f.add_column('Ratio', align='>')
+    f.print(
+        (size,
+         name,
+         '{:.1f}ms'.format(duration * 1e3),
+         '{:.1f}ms'.format(baseline_duration * 1e3)
+         if baseline_duration else '',
+         '{:.2f}{}'.format(duration / baseline_duration,
+                           ' !' if regressed else '')
+         if baseline_duration else '')
+        for size, name, duration, baseline_duration, regressed in comparison
+    )
+
+    if save:
+        bench.save_baseline(save, results)
+
+    if any(regressed for *_, regressed in comparison):
+        click.echo('Regressions detected, marked with !', err=True)
+        sys.exit(1)
+
+
+def run_benchmarks(app, end, repeat):
+    """Time the commands, and the functions behind them, on a ledger app."""
+    import collections
+    import contextlib
+    from . import bench
+    from . import ql
+
+    context = click.Context(main, obj=app)
+    accounts = app.accounts
+    since = end - datetime.timedelta(days=bench.ledger_days)
+    delta = util.create_delta('1 month')
+
+    rows = app.db.cursor().execute('''
+        SELECT date, account, type, amount, description
+        FROM "transaction"
+        LIMIT 100000
+        ''').fetchall()
+
+    def render():
+        f = TableFormatter()
+        f.max_width = 120
+        for label in ('Date', 'Account', 'Type', 'Amount', 'Description'):
+            f.add_column(label)
+        f.print(rows)
+
+    def invoke(command, **params):
+        return lambda: context.invoke(command, **params)
+
+    def search_all(**params):
+        return lambda: [context.invoke(search, query=query, **params)
+                        for query in bench.queries]
+
+    benchmarks = (
+        ('ql.build',
+         lambda: [ql.build.__wrapped__(query) for query in bench.queries]),
+        ('search', search_all(output_format='tsv')),
+        ('search --limit 100', search_all(output_format='tsv', limit=100)),
+        ('search --count-only', search_all(count_only=True)),
+        ('search --group-by month', search_all(output_format='tsv',
+                                               group_by='month')),
+        ('tail -n 1000', invoke(tail, n=1000, output_format='tsv')),
+        ('balances', invoke(balances, output_format='tsv')),
+        ('format_series', lambda: util.format_series(accounts, since, delta)),
+        ('update_transactions',
+         lambda: [account.update_transactions() for account in accounts]),
+        ('TableFormatter', render),
+    )
+
+    results = collections.OrderedDict()
+    with open(os.devnull, 'w') as devnull:
+        for name, function in benchmarks:
+            with contextlib.redirect_stdout(devnull), \
+                    contextlib.redirect_stderr(devnull):
+                results[name] = bench.measure(function, repeat)
+
+    return results
 
 
 @main.command(
@@ -269,12 +689,14 @@ def reindex(app):
 def config_command(app, type):
 
     if type == 'json':
+        import json
         click.echo(json.dumps(app.config,
                               default=util.json_default,
                               indent=2))
 
     elif type == 'yaml':
-        click.echo(yaml.dump(app.config, Dumper=util.YamlDumper))
+        from . import yamlutil
+        click.echo(yamlutil.dump(app.config))
 
 if __name__ == '__main__':
     main()
@@ -2,8 +2,11 @@ import importlib
 import datetime
 
 from .adaptor import Adaptor
-from .util import format_date, generate_dates, create_date
-from .transaction import Transaction
+from .util import format_date, create_date, chunks
+from .balance import refresh_daily_balance
+from . import instrument
+from . import searchindex
+from .transaction import Transaction, hash_transactions
 
 
 class AdaptorNotFound(Exception):
@@ -36,7 +39,7 @@ class Account(object):
 
         self.id = id
         self.app = app
-        self.adaptor = self.create_adaptor()
+        self._adaptor = None
 
     @property
     def config(self):
@@ -46,6 +49,14 @@ class Account(object):
     def db(self):
         return self.app.db
 
+    @property
+    def adaptor(self):
+        # Created on first use, so that commands working on the database
+        # only don't import adaptors and their dependencies
+        if self._adaptor is None:
+            self._adaptor = self.create_adaptor()
+        return self._adaptor
+
     def create_adaptor(self):
         name = self.config.type
         if not name:
@@ -81,46 +92,32 @@ class Account(object):
 
     def get_balance(self, since=None):
         row = self.db.cursor().execute('''
-            SELECT balance_amount - (
-                SELECT TOTAL(amount)
-                FROM "transaction"
-                WHERE "transaction".account == "account".id
-                  AND "transaction".date >= ?
-            ) AS balance
+            SELECT balance_amount - IFNULL((
+                SELECT closing_balance
+                FROM daily_balance
+                WHERE daily_balance.account == "account".id
+                ORDER BY date DESC
+                LIMIT 1
+            ), 0) + IFNULL((
+                SELECT closing_balance
+                FROM daily_balance
+                WHERE daily_balance.account == "account".id
+                  AND daily_balance.date < ?
+                ORDER BY date DESC
+                LIMIT 1
+            ), 0) AS balance
             FROM "account"
             WHERE "account".id = ?
-            ''', (format_date(since) if since else 0, self.id)).fetchone()
+            ''', (format_date(since) if since else '', self.id)).fetchone()
 
         if not row:
             return 0
 
         return row['balance']
 
-    def iter_transactions_by_dates(self, since=None, delta=None, until=None):
-        transactions = self.iter_transactions(since=since)
-        next_transaction = next(transactions)
-        for date in generate_dates(since or next_transaction.date,
-                                   delta or datetime.timedelta(days=1)):
-
-            if (until is None and next_transaction is None) or \
-                    (until is not None and date >= until):
-                break
-
-            date_transactions = []
-
-            if next_transaction:
-                try:
-                    while next_transaction.date <= date:
-                        date_transactions.append(next_transaction)
-                        next_transaction = next(transactions)
-                except StopIteration:
-                    next_transaction = None
-
-            yield date, date_transactions
-
     def iter_transactions(self, since=None):
         query = '''
-            SELECT date, id, type, amount, description
+            SELECT hash, date, id, type, amount, description
             FROM "transaction"
             WHERE account = ?
               AND date >= ?
@@ -130,7 +127,7 @@ class Account(object):
         for row in self.db.cursor().execute(
                 query,
                 (self.id, format_date(since) if since else 0)):
-            yield Transaction(account=self, **row)
+            yield Transaction.from_row(self, row)
 
     def transaction_count(self):
         return self.db.cursor().execute('''
@@ -140,7 +137,9 @@ class Account(object):
         ''', (self.id,)).fetchone()[0]
 
     def update_balance(self):
-        date, amount = self.adaptor.fetch_balance()
+        self.store_balance(*self.adaptor.fetch_balance())
+
+    def store_balance(self, date, amount):
         self.db.cursor().execute('''
             INSERT OR REPLACE INTO "account"
               (id, balance_date, balance_amount)
@@ -148,32 +147,160 @@ class Account(object):
             ''', (self.id, format_date(date), amount))
         self.db.commit()
 
-    def update_transactions(self):
-        cursor = self.db.cursor()
-        date_row = cursor.execute('SELECT "date" '
-                                  'FROM "transaction" '
-                                  'WHERE account = ? '
-                                  'ORDER BY "date" DESC',
-                                  (self.id,)).fetchone()
-
-        date = create_date(date_row['date']) - datetime.timedelta(days=10) \
+    def update_since(self):
+        date_row = self.db.cursor().execute('SELECT "date" '
+                                            'FROM "transaction" '
+                                            'WHERE account = ? '
+                                            'ORDER BY "date" DESC',
+                                            (self.id,)).fetchone()
+
+        return create_date(date_row['date']) - datetime.timedelta(days=10) \
             if date_row else create_date('01-01-2013')
 
+    def update_transactions(self):
+        since = self.update_since()
+        return self.store_transactions(self.adaptor.fetch_transactions(since),
+                                       since=since)
+
+    def store_transactions(self, transactions, since=None):
+        writer = TransactionWriter(self, since=since)
+        try:
+            for chunk in chunks(transactions, writer.chunk_size):
+                writer.write(chunk)
+        except BaseException:
+            writer.rollback()
+            raise
+        writer.close()
+        return writer
+
+
+class TransactionWriter(object):
+    """Store transactions of an account, chunk by chunk. Daily balances are
+    refreshed, the search index is merged and changes are committed when
+    closing the writer.
+
+    If `since` is given, transactions are expected to be every transaction
+    of the account from this date. Transactions already stored are skipped,
+    and the ones stored but not written again are counted as vanished.
+
+    If the transactions can't all be fetched, `rollback` removes the ones
+    written so far, even if another writer committed them: an interrupted
+    download would otherwise leave holes that later updates don't fill.
+    """
+
+    chunk_size = 1000
+
+    # Merge the search index after writing this many transactions
+    merge_threshold = 1000
+
+    def __init__(self, account, since=None):
+        self.account = account
+        self.first_date = None
+        self.new = 0
+        self.unchanged = 0
+        self._stored_hashes = set()
+        self._written_hashes = set()
+        # Rowid ranges of the inserted transactions, as (after, last) tuples,
+        # `last` being None while inserting
+        self._inserted_rowids = []
+
+        if since is not None:
+            self._stored_hashes = set(
+                int(row[0]) for row in account.db.cursor().execute('''
+                    SELECT hash
+                    FROM "transaction"
+                    WHERE account = ?
+                      AND date >= ?
+                    ''', (account.id, format_date(since))))
+
+    @property
+    def vanished(self):
+        return len(self._stored_hashes)
+
+    @instrument.timed('store')
+    def write(self, transactions):
+        account_id = self.account.id
+        first_date = self.first_date
+        stored_hashes = self._stored_hashes
+        written_hashes = self._written_hashes
+        rows = []
+
+        for transaction in hash_transactions(transactions):
+            hash = transaction.hash
+
+            if hash in stored_hashes:
+                stored_hashes.remove(hash)
+                written_hashes.add(hash)
+                self.unchanged += 1
+                continue
+
+            if hash in written_hashes:
+                self.unchanged += 1
+                continue
+
+            written_hashes.add(hash)
+
+            date = format_date(transaction.date)
+            if first_date is None or date < first_date:
+                first_date = date
+
+            rows.append((
+                hash,
+                account_id,
+                date,
+                transaction.id,
+                transaction.type,
+                transaction.amount,
+                transaction.description
+            ))
+
+        if not rows:
+            return
+
+        cursor = self.account.db.cursor()
+        last_rowid = cursor.execute(
+            'SELECT IFNULL(MAX(rowid), 0) FROM "transaction"').fetchone()[0]
+        self._inserted_rowids.append((last_rowid, None))
         cursor.executemany(
-            'INSERT OR REPLACE INTO "transaction" '
+            'INSERT OR IGNORE INTO "transaction" '
             '  (hash, account, date, id, type, amount, description) '
             'VALUES (?, ?, ?, ?, ?, ?, ?)',
-            (
-                (
-                    transaction.hash,
-                    transaction.account.id,
-                    format_date(transaction.date),
-                    transaction.id,
-                    transaction.type,
-                    transaction.amount,
-                    transaction.description
-                ) for transaction in self.adaptor.fetch_transactions(date)
-            )
-        )
-
-        self.db.commit()
+            rows)
+
+        # Transactions can't be modified, so the ignored ones are unchanged
+        inserted = cursor.rowcount
+
+        # Inserted rows get the rowids following the greatest one
+        self._inserted_rowids[-1] = (last_rowid, last_rowid + inserted)
+
+        self.first_date = first_date
+        self.new += inserted
+        self.unchanged += len(rows) - inserted
+
+    @instrument.timed('store')
+    def close(self):
+        if self.first_date is not None:
+            refresh_daily_balance(self.account.db.cursor(),
+                                  self.account.id,
+                                  self.first_date)
+
+        if self.new >= self.merge_threshold:
+            searchindex.merge(self.account.db.cursor())
+
+        self.account.db.commit()
+
+    @instrument.timed('store')
+    def rollback(self):
+        cursor = self.account.db.cursor()
+        for after, last in self._inserted_rowids:
+            cursor.execute('''
+                DELETE FROM "transaction"
+                WHERE account = ?
+                  AND rowid > ?
+                  AND rowid <= IFNULL(?, rowid)
+                ''', (self.account.id, after, last))
+
+        self.account.db.commit()
+        self._inserted_rowids = []
+        self.first_date = None
+        self.new = 0
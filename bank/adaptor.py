@@ -1,5 +1,8 @@
 
 
+from . import instrument
+
+
 class AdaptorError(Exception):
     pass
 
@@ -10,9 +13,22 @@ class ActionNotAvailaible(AdaptorError):
 
 class AdaptorMeta(type):
 
+    # Adaptor methods timed when profiling
+    instrumented_methods = ('create_session',
+                            'fetch_balance',
+                            'fetch_transactions')
+
     def __new__(cls, name, bases, namespace):
         if 'create_session' in namespace:
             namespace['_sessions'] = {}
+
+        for method in cls.instrumented_methods:
+            if method in namespace:
+                namespace[method] = instrument.instrumented(
+                    'adaptor',
+                    '{}.{}'.format(name, method),
+                    namespace[method])
+
         return super().__new__(cls, name, bases, namespace)
 
 
@@ -27,11 +43,26 @@ class Adaptor(metaclass=AdaptorMeta):
         sessions = self._sessions
 
         if name not in sessions:
-            sessions[name] = self.create_session(
-                self.account.app.config.sessions.get(name))
+            config = self.account.app.config.sessions.get(name)
+            session = self.create_session(config)
+
+            # Sessions of the requests library share the same transport
+            if hasattr(session, 'mount'):
+                from . import transport
+                transport.configure(session,
+                                    config,
+                                    self.account.app.cache_path('http', name))
+
+            sessions[name] = session
 
         return sessions[name]
 
+    @property
+    def session_key(self):
+        """Identify the session shared by this adaptor. Accounts with the same
+        key share the same session and can't be updated concurrently."""
+        return id(self._sessions), self._session_name
+
     @property
     def _session_name(self):
         a = self.account.config
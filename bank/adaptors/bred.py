@@ -1,10 +1,13 @@
 from urllib.parse import urljoin
+import contextlib
 import logging
 import re
 
 import click
 import requests
 
+from .. import httpcache
+from .. import sessionstore
 from ..transaction import tsv_parser
 from ..adaptor import Adaptor, AdaptorError
 from ..util import create_date
@@ -21,10 +24,13 @@ class Session(requests.Session):
 
     root_url = 'https://www.bred.fr/Andromede/'
 
-    def __init__(self, identifier=None, password=None):
+    def __init__(self, identifier=None, password=None, store=None):
         super().__init__()
         self.identifier = identifier
         self.password = password
+        self.store = store
+        # Whether the cookies come from a previous run, and may have expired
+        self.restored = bool(store and store.load(self.cookies))
 
     def _authentificate(self):
         if not self.identifier or not self.password:
@@ -37,6 +43,14 @@ class Session(requests.Session):
         }
 
         self.post('MainAuth', data=auth_data)
+        self.restored = False
+
+    def logout(self):
+        """Forget the cookies, so the next request logs in again."""
+        self.cookies.clear()
+        self.restored = False
+        if self.store:
+            self.store.clear()
 
     def prepare_request(self, request):
         if 'bredplone_cookie' not in self.cookies and \
@@ -47,17 +61,56 @@ class Session(requests.Session):
         return super().prepare_request(request)
 
     def send(self, request, **kwargs):
-        logger.debug('send', request.url)
-        return super().send(request, **kwargs)
+        logger.debug('send %s', request.url)
+        response = super().send(request, **kwargs)
+        if self.store:
+            self.store.save(self.cookies)
+        return response
+
+
+def is_download(response):
+    # Errors, and login pages when the session expired, are HTML pages
+    return 'text/html' not in response.headers.get('content-type', '')
+
+
+def parse_balance(content):
+    return re.search(r'Solde après dernière opération enregistrée le '
+                     r'(\d\d/\d\d/\d\d\d\d) : '
+                     r'[<>a-z ]*(-?[\d\s]+,\d+)\sEUR',
+                     content)
 
 
 class BredAdaptor(Adaptor):
 
+    # Downloads have no charset
+    download_encoding = 'cp1252'
+    download_chunk_size = 64 * 1024
+
     def create_session(self, config):
         identifier = config.identifier or click.prompt('BRED identifier')
         password = config.password or click.prompt('BRED password',
                                                    hide_input=True)
-        return Session(identifier, password)
+        store = None
+        if config.store_session is not False:
+            store = sessionstore.create(
+                self.account.app.cache_path('sessions'),
+                self._session_name, identifier, password)
+
+        return Session(identifier, password, store)
+
+    def get(self, url, is_valid, **kwargs):
+        """Get a page, logging in again if it is not valid while using the
+        cookies of a previous run, which probably expired."""
+        response = self.session.get(url, **kwargs)
+
+        if not is_valid(response) and self.session.restored:
+            logger.info('Session expired, logging in again')
+            httpcache.discard(response)
+            response.close()
+            self.session.logout()
+            response = self.session.get(url, **kwargs)
+
+        return response
 
     def fetch_transactions(self, since):
         download_params = {
@@ -73,16 +126,29 @@ class BredAdaptor(Adaptor):
 
         self.set_account_data(download_params)
 
-        request = self.session.get('Telechargement',
-                                   params=download_params)
+        response = self.get('Telechargement',
+                            is_download,
+                            params=download_params,
+                            stream=True)
 
-        if 'text/html' in request.headers.get('content-type', ''):
+        if not is_download(response):
+            response.close()
+            httpcache.discard(response)
             return set()
 
         return tsv_parser(self.account,
-                          request.text.split('\n'),
+                          self._iter_lines(response),
                           create_date=lambda d: create_date(d, dayfirst=True))
 
+    def _iter_lines(self, response):
+        # Read the download incrementally instead of loading it as a whole
+        if not response.encoding:
+            response.encoding = self.download_encoding
+
+        with contextlib.closing(response):
+            yield from response.iter_lines(chunk_size=self.download_chunk_size,
+                                           decode_unicode=True)
+
     def fetch_balance(self):
 
         params = {
@@ -93,14 +159,14 @@ class BredAdaptor(Adaptor):
 
         self.set_account_data(params)
 
-        content = self.session.get('Main', params=params).text
+        response = self.get('Main',
+                            lambda response: parse_balance(response.text),
+                            params=params)
 
-        result = re.search(r'Solde après dernière opération enregistrée le '
-                           r'(\d\d/\d\d/\d\d\d\d) : '
-                           r'[<>a-z ]*(-?[\d\s]+,\d+)\sEUR',
-                           content)
+        result = parse_balance(response.text)
 
         if not result:
+            httpcache.discard(response)
             raise Exception('Can\'t parse balance')
 
         date, amount = result.groups()
@@ -0,0 +1,86 @@
+"""Maintenance of the `daily_balance` table.
+
+For each account and each day having transactions, the table stores the sum
+and the number of the transactions of that day (`delta_sum` and `count`), and
+the running total of all the account transactions up to that day
+(`closing_balance`). The actual balance of an account at the end of a day is
+its current balance minus the last closing balance plus the closing balance
+of that day.
+"""
+import bisect
+
+
+def refresh_daily_balance(cursor, account_id, since=''):
+    """Recompute the daily balances of an account from the `since` date (a
+    formatted date string) onwards."""
+
+    row = cursor.execute('''
+        SELECT closing_balance
+        FROM daily_balance
+        WHERE account = ?
+          AND date < ?
+        ORDER BY date DESC
+        LIMIT 1
+        ''', (account_id, since)).fetchone()
+
+    closing_balance = row[0] if row else 0
+
+    cursor.execute('''
+        DELETE FROM daily_balance
+        WHERE account = ?
+          AND date >= ?
+        ''', (account_id, since))
+
+    days = cursor.execute('''
+        SELECT date, TOTAL(amount), COUNT(*)
+        FROM "transaction"
+        WHERE account = ?
+          AND date >= ?
+        GROUP BY date
+        ORDER BY date
+        ''', (account_id, since)).fetchall()
+
+    def iter_rows():
+        nonlocal closing_balance
+        for date, delta_sum, count in days:
+            closing_balance += delta_sum
+            yield account_id, date, delta_sum, closing_balance, count
+
+    cursor.executemany('''
+        INSERT INTO daily_balance
+          (account, date, delta_sum, closing_balance, count)
+        VALUES (?, ?, ?, ?, ?)
+        ''', iter_rows())
+
+
+def sum_by_buckets(cursor, account_ids, dates):
+    """Sum the daily balances of accounts by buckets, in a single query.
+
+    `dates` are sorted formatted dates, each one ending a bucket: the bucket
+    of a day is the index of the first date greater or equal to it. Days
+    before the first date or after the last one are ignored. Return a dict
+    mapping `(account_id, bucket_index)` to `(delta_sum, count)` tuples.
+    """
+
+    if not dates or not account_ids:
+        return {}
+
+    dates = tuple(dates)
+    cursor.connection.create_function(
+        'bucket_index', 1, lambda date: bisect.bisect_left(dates, date))
+
+    rows = cursor.execute('''
+        SELECT account, bucket_index(date) AS bucket,
+               TOTAL(delta_sum), TOTAL(count)
+        FROM daily_balance
+        WHERE account IN ({})
+          AND date >= ?
+          AND date <= ?
+        GROUP BY account, bucket
+        '''.format(', '.join('?' * len(account_ids))),
+        tuple(account_ids) + (dates[0], dates[-1]))
+
+    return {
+        (account_id, bucket): (delta_sum, int(count))
+        for account_id, bucket, delta_sum, count in rows
+    }
@@ -0,0 +1,168 @@
+"""Benchmarks over synthetic ledgers.
+
+Ledgers of a given number of transactions, spread over a few accounts, are
+generated once with a stub adaptor and kept in the cache directory. The
+`bank bench` command then times common operations on them. Results can be
+saved as a JSON baseline, which later runs are compared to.
+"""
+import collections
+import datetime
+import json
+import os
+import random
+import sqlite3
+import time
+
+from .adaptor import Adaptor
+from .transaction import Transaction
+from .util import atomic_write, format_date, parse_date
+
+sizes = collections.OrderedDict((
+    ('10k', 10000),
+    ('100k', 100000),
+    ('1m', 1000000),
+))
+
+# Ledgers span ten years, up to the day they are generated
+ledger_days = 10 * 365
+
+# (type, description template, minimum amount, maximum amount)
+templates = (
+    ('card', 'CB AMAZON EU SARL {day:02}/{month:02}', -150, -5),
+    ('card', 'CB CARREFOUR CITY {city} {day:02}/{month:02}', -90, -3),
+    ('card', 'CB SNCF INTERNET {ref}', -180, -15),
+    ('card', 'CB PAYPAL EUROPE {ref}', -120, -5),
+    ('withdrawal', 'RETRAIT DAB {city} {day:02}/{month:02}', -200, -20),
+    ('debit', 'PRLV SEPA EDF CLIENTS PARTICULIERS {ref}', -110, -40),
+    ('debit', 'PRLV SEPA FREE MOBILE {ref}', -30, -10),
+    ('loan', 'ECHEANCE PRET IMMOBILIER {ref}', -900, -900),
+    ('transfer', 'VIR SEPA SALAIRE {month:02}/{year}', 1800, 2600),
+    ('transfer', 'VIR SEPA REMBOURSEMENT {ref}', 5, 300),
+    ('check', 'CHEQUE {ref}', -500, -10),
+)
+
+cities = ('PARIS', 'LYON', 'NANTES', 'LILLE', 'BORDEAUX', 'MARSEILLE')
+
+# Search queries used by the benchmarks
+queries = (
+    'amazon',
+    'amazon since 1 year',
+    'sncf or paypal',
+    'carrefour between 2015-01-01 and 2015-12-31',
+    'not amazon more than 100',
+    'type:card less than -50',
+    'since 3 months',
+)
+
+
+def generate_transactions(account, count, end, since=None):
+    """Generate `count` transactions of an account until the `end` date, in
+    chronological order. The same transactions are generated for a same
+    account id and end date."""
+    rnd = random.Random(account.id)
+    start = end - datetime.timedelta(days=ledger_days)
+
+    for index in range(count):
+        date = start + datetime.timedelta(days=index * ledger_days // count)
+        type, template, minimum, maximum = rnd.choice(templates)
+        amount = round(rnd.uniform(minimum, maximum), 2)
+        description = template.format(day=date.day,
+                                      month=date.month,
+                                      year=date.year,
+                                      city=rnd.choice(cities),
+                                      ref=rnd.randrange(10 ** 7))
+
+        if since is None or date >= since:
+            yield Transaction(account, date, index, type, amount,
+                              description)
+
+
+class StubAdaptor(Adaptor):
+    """Serve generated transactions, `count` and `end` being given by the
+    account configuration."""
+
+    @property
+    def end(self):
+        return parse_date(self.account.config.end)
+
+    def create_session(self, config):
+        return object()
+
+    def fetch_balance(self):
+        return self.end, 1000.0
+
+    def fetch_transactions(self, since):
+        return generate_transactions(self.account,
+                                     self.account.config.count,
+                                     self.end,
+                                     since)
+
+
+def ledger_end(path):
+    """Return the end date of an existing ledger, or today's date."""
+    if not os.path.exists(path):
+        return datetime.date.today()
+
+    connection = sqlite3.connect(path)
+    try:
+        end, = connection.execute(
+            'SELECT MAX(balance_date) FROM "account"').fetchone()
+    finally:
+        connection.close()
+    return parse_date(end)
+
+
+def ledger_config(path, size, account_count, end):
+    return {
+        'database': path,
+        'query_cache': False,
+        'accounts': collections.OrderedDict(
+            ('{:06}-000'.format(index), {
+                'name': 'Account {}'.format(index),
+                'type': __name__,
+                'count': size // account_count,
+                'end': format_date(end),
+            })
+            for index in range(account_count)),
+    }
+
+
+def create_ledger(app):
+    """Fill the database of an app configured by `ledger_config`."""
+    for account in app.accounts:
+        account.update_balance()
+        account.store_transactions(account.adaptor.fetch_transactions(None))
+
+
+def measure(function, repeat=3):
+    """Return the best duration of `repeat` calls of `function`, in
+    seconds."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def load_baseline(path):
+    with open(path, encoding='utf-8') as fp:
+        return json.load(fp, object_pairs_hook=collections.OrderedDict)
+
+
+def save_baseline(path, results):
+    with atomic_write(path, encoding='utf-8') as fp:
+        json.dump(results, fp, indent=2)
+
+
+def compare(results, baseline, threshold=1.2):
+    """Iterate over `(size, name, duration, baseline_duration, regressed)`
+    tuples, `regressed` being true when the duration exceeds the baseline
+    one by more than the `threshold` ratio."""
+    for size, durations in results.items():
+        baseline_durations = baseline.get(size, {})
+        for name, duration in durations.items():
+            baseline_duration = baseline_durations.get(name)
+            regressed = baseline_duration is not None and \
+                duration > baseline_duration * threshold
+            yield size, name, duration, baseline_duration, regressed
@@ -1,6 +1,11 @@
-import yaml
+import collections
+import json
+import logging
 import os
-from .util import YamlLoader, YamlDumper
+
+from .util import atomic_write
+
+logger = logging.getLogger(__name__)
 
 
 class Config(object):
@@ -9,6 +14,7 @@ class Config(object):
 
     def __init__(self, config, root_path=None):
         self._config = config or {}
+        self._children = {}
         self.root_path = os.getcwd() if root_path is None else root_path
 
     def _cast(self, value):
@@ -28,8 +34,8 @@ class Config(object):
 
     def __iter__(self):
         return (
-            (key, self._cast(value))
-            for key, value in self._config.items()
+            (key, self.get(key))
+            for key in self._config
         )
 
     def __bool__(self):
@@ -39,7 +45,15 @@ class Config(object):
         return self._config
 
     def get(self, attr, default=None):
-        return self._cast(self._config.get(attr, default))
+        if attr not in self._config and default is not None:
+            return self._cast(default)
+
+        # Children are cast once, the configuration being read only
+        try:
+            return self._children[attr]
+        except KeyError:
+            child = self._children[attr] = self._cast(self._config.get(attr))
+            return child
 
     def getpath(self, attr, default=None):
         value = self.get(attr, default)
@@ -50,18 +64,97 @@ class Config(object):
             os.path.expanduser(value)))
 
 
-YamlDumper.add_representer(
-    Config,
-    lambda r, c: YamlDumper.represent_dict(r, c._config))
-
-
-def from_yaml(path, default=None):
+class ParsedCache(object):
+    """Cache of a parsed configuration file, stored as JSON and valid as long
+    as the file modification time and size don't change. This spares the
+    import of `yaml` and the parsing of the file.
+
+    Configurations with session credentials, or with `config_cache: false`,
+    are not cached. The cache file is only readable by its owner."""
+
+    version = 1
+
+    # Session settings which are not written in the cache
+    secret_keys = ('identifier', 'password')
+
+    def __init__(self, path):
+        self.path = path
+
+    def _key(self, config_path):
+        stat = os.stat(config_path)
+        return [os.path.abspath(config_path), stat.st_mtime_ns, stat.st_size]
+
+    def load(self, config_path):
+        """Return a `(found, raw)` tuple."""
+        try:
+            with open(self.path, encoding='utf-8') as fp:
+                content = json.load(fp,
+                                    object_pairs_hook=collections.OrderedDict)
+        except (OSError, ValueError):
+            return False, None
+
+        if content.get('version') != self.version or \
+                content.get('key') != self._key(config_path):
+            return False, None
+
+        return True, content['config']
+
+    def has_secrets(self, raw):
+        sessions = raw.get('sessions') or {}
+        return any(
+            isinstance(session, dict) and
+            any(session.get(key) for key in self.secret_keys)
+            for session in sessions.values())
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def store(self, config_path, raw):
+        if not isinstance(raw, dict) or \
+                raw.get('config_cache') is False or self.has_secrets(raw):
+            logger.debug('Not caching %s', config_path)
+            self.clear()
+            return
+
+        content = json.dumps({
+            'version': self.version,
+            'key': self._key(config_path),
+            'config': raw,
+        }, default=str)
+
+        # Values JSON can't represent as is, like dates, aren't cached
+        loaded = json.loads(content, object_pairs_hook=collections.OrderedDict)
+        if loaded['config'] != raw:
+            logger.debug('Not caching %s, it is not JSON compatible',
+                         config_path)
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with atomic_write(self.path, encoding='utf-8') as fp:
+            fp.write(content)
+
+
+def from_yaml(path, default=None, cache_path=None):
     if default is not None:
         if not path or not os.path.isfile(path):
             return Config(default)
 
-    with open(path, 'rb') as config_fp:
-        raw = yaml.load(config_fp, YamlLoader)
+    cache = ParsedCache(cache_path) if cache_path else None
+    found, raw = cache.load(path) if cache else (False, None)
+
+    if not found:
+        from . import yamlutil
+        with open(path, 'rb') as config_fp:
+            raw = yamlutil.load(config_fp)
+
+        if cache:
+            try:
+                cache.store(path, raw)
+            except OSError as e:
+                logger.warning('Failed to cache %s: %s', path, e)
 
     return Config(raw, os.path.dirname(path))
 
@@ -1,59 +1,81 @@
+import logging
 import sqlite3
+import types
+
+from . import instrument
+from .migrations import migrations
+
+logger = logging.getLogger(__name__)
+
+tuning_pragmas = {
+    'journal_mode': ('delete', 'truncate', 'persist', 'memory', 'wal', 'off'),
+    'synchronous': ('off', 'normal', 'full', 'extra'),
+    'temp_store': ('default', 'file', 'memory'),
+    'mmap_size': int,
+    'cache_size': int,
+}
+
+default_tuning = {
+    # Readers don't block the writer, and commits don't need to fsync the
+    # database file
+    'journal_mode': 'wal',
+    # Safe with WAL: a power loss may only rollback the last commits
+    'synchronous': 'normal',
+    # 256 MiB
+    'mmap_size': 256 * 2 ** 20,
+    # Negative values are expressed in KiB: 64 MiB
+    'cache_size': -64 * 2 ** 10,
+    'temp_store': 'memory',
+}
+
+
+def format_pragma(name, value):
+    if name not in tuning_pragmas:
+        raise ValueError('unknown database tuning option {!r}'.format(name))
+
+    expected = tuning_pragmas[name]
+
+    # YAML reads unquoted off, no or false as False, and on, yes or true as
+    # True
+    if isinstance(value, bool):
+        if value or expected is int or 'off' not in expected:
+            raise ValueError('invalid value {!r} for database tuning option '
+                             '{!r}, quote it to use it as a string'
+                             .format(value, name))
+        value = 'off'
+
+    if expected is int:
+        value = int(value)
+    else:
+        value = str(value).lower()
+        if value not in expected:
+            raise ValueError('invalid value {!r} for database tuning option '
+                             '{!r}, expected one of {}'
+                             .format(value, name, ', '.join(expected)))
+
+    return 'PRAGMA {} = {}'.format(name, value)
 
 
 class DB(object):
 
     _connection = None
 
-    def __init__(self, path):
+    # Apply pending migrations when connecting
+    auto_migrate = True
+
+    def __init__(self, path, tuning=None):
         self.path = path
+        self.tuning = dict(default_tuning)
+        for name, value in tuning or ():
+            self.tuning[name] = value
 
     def __del__(self):
+        self.close()
+
+    def close(self):
         if self._connection:
             self._connection.close()
-
-    def _create_db(self):
-
-        self.cursor().executescript(r'''
-            CREATE TABLE "transaction" (
-                hash TEXT PRIMARY KEY,
-                account TEXT,
-                date TEXT,
-                id INTEGER,
-                type TEXT,
-                amount REAL,
-                description TEXT
-            );
-
-            CREATE TABLE "account" (
-                id TEXT PRIMARY KEY,
-                balance_date TEXT,
-                balance_amount REAL
-            );
-
-            CREATE VIRTUAL TABLE "transaction_search" USING fts4(
-                account,
-                type,
-                description
-            );
-
-            CREATE TRIGGER IF NOT EXISTS insert_transaction_trigger
-            AFTER INSERT ON "transaction"
-            BEGIN
-                INSERT OR IGNORE INTO "transaction_search" (
-                    docid,
-                    account,
-                    type,
-                    description
-                )
-                VALUES (
-                    NEW.hash,
-                    NEW.account,
-                    NEW.type,
-                    NEW.description
-                );
-            END;
-        ''')
+            self._connection = None
 
     @property
     def connection(self):
@@ -64,18 +86,146 @@ class DB(object):
         connection.row_factory = sqlite3.Row
         self._connection = connection
 
-        count = self.cursor().execute('''
-            SELECT count(*) AS count
-            FROM sqlite_master WHERE type='table'
-        ''').fetchone()['count']
+        self._apply_tuning()
 
-        if not count:
-            self._create_db()
+        # Fire delete triggers on rows replaced by INSERT OR REPLACE, so the
+        # search index is kept in sync
+        self.cursor().execute('PRAGMA recursive_triggers = ON')
+
+        if self.auto_migrate:
+            self.migrate()
 
         return connection
 
+    def _apply_tuning(self):
+        cursor = self.cursor()
+        for name, value in sorted(self.tuning.items()):
+            # Null values keep the SQLite default
+            if value or isinstance(value, bool) or value == 0:
+                cursor.execute(format_pragma(name, value))
+
+    @property
+    def version(self):
+        version = self.cursor().execute('PRAGMA user_version').fetchone()[0]
+
+        if not version:
+            count = self.cursor().execute('''
+                SELECT count(*) AS count
+                FROM sqlite_master WHERE type='table'
+            ''').fetchone()['count']
+
+            # Databases created before schema versioning have the initial
+            # schema
+            if count:
+                version = 1
+
+        return version
+
+    @property
+    def latest_version(self):
+        return len(migrations)
+
+    def pending_migrations(self):
+        return tuple(migrations[self.version:])
+
+    def migrate(self, callback=None):
+        for migration in self.pending_migrations():
+            logger.info('Migrating database to version %s: %s',
+                        migration.version, migration.description)
+
+            if callback:
+                callback(migration)
+
+            self._run_migration(migration)
+
+    def _run_migration(self, migration):
+        connection = self.connection
+        cursor = connection.cursor()
+
+        try:
+            cursor.execute('BEGIN')
+            batches = migration.function(cursor)
+
+            if isinstance(batches, types.GeneratorType):
+                for _ in batches:
+                    connection.commit()
+                    cursor.execute('BEGIN')
+
+            cursor.execute('PRAGMA user_version = {:d}'
+                           .format(migration.version))
+        except BaseException:
+            connection.rollback()
+            raise
+        else:
+            connection.commit()
+
     def cursor(self):
-        return self.connection.cursor()
+        cursor = self.connection.cursor()
+        if instrument.recorder is not None:
+            return instrument.Cursor(cursor)
+        return cursor
 
     def commit(self):
         return self.connection.commit()
+
+    def query_plan(self, query, arguments=()):
+        return tuple(
+            row['detail']
+            for row in self.cursor().execute('EXPLAIN QUERY PLAN ' + query,
+                                             arguments))
+
+
+if __name__ == '__main__':
+    import datetime
+    from bank.config import Config
+    from bank.account import Account
+
+    class App(object):
+        config = Config({'accounts': {'a': {}}})
+        db = DB(':memory:')
+
+    class PlanAccount(Account):
+        def create_adaptor(self):
+            pass
+
+    # Options read from YAML
+    assert format_pragma('synchronous', False) == 'PRAGMA synchronous = off'
+    assert format_pragma('journal_mode', 'WAL') == 'PRAGMA journal_mode = wal'
+    assert format_pragma('cache_size', -2000) == 'PRAGMA cache_size = -2000'
+    for name, value in (('synchronous', True), ('temp_store', False),
+                        ('mmap_size', False), ('synchronous', 'on')):
+        try:
+            format_pragma(name, value)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('{} = {!r} should be invalid'
+                                 .format(name, value))
+
+    app = App()
+    account = PlanAccount(app, 'a')
+    statements = []
+    app.db.connection.set_trace_callback(statements.append)
+
+    account.get_balance(datetime.date.today())
+    account.get_balance()
+    tuple(account.iter_transactions(since=datetime.date.today()))
+    account.transaction_count()
+    account.update_since()
+
+    app.db.connection.set_trace_callback(None)
+
+    statements.append('''
+    SELECT * FROM (
+        SELECT date, account, type, amount, description
+        FROM "transaction" ORDER BY date DESC
+        LIMIT 10
+    ) ORDER BY date
+    ''')
+
+    for statement in statements:
+        for detail in app.db.query_plan(statement):
+            if detail.startswith('SCAN transaction') and \
+                    'USING' not in detail:
+                raise AssertionError('\n{}\ndoes not use an index: {}'
+                                     .format(statement, detail))
@@ -0,0 +1,327 @@
+"""On disk cache of the HTTP responses of adaptor sessions.
+
+Successful GET responses are stored in a directory, one file per URL, which
+includes the request parameters and thus the account. A stored response is
+served without any request during `ttl` seconds. Past that, it is revalidated
+with its `ETag` and `Last-Modified` headers when it has some: a `304 Not
+Modified` answer refreshes it without transferring the body again.
+
+Banks usually forbid the caching of their pages, so the `Cache-Control`
+headers of responses are ignored: the cache is private, and only used when
+configured.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from requests.packages.urllib3.response import HTTPResponse
+from requests.structures import CaseInsensitiveDict
+
+from .transport import TransportAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class CachingAdapter(TransportAdapter):
+
+    version = 1
+
+    # Response headers which are not stored, nor replayed
+    ignored_headers = frozenset((
+        'connection',
+        'keep-alive',
+        'set-cookie',
+        'transfer-encoding',
+    ))
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path, ttl=0, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(path, exist_ok=True)
+
+    def entry_path(self, request):
+        key = '{} {}'.format(request.method, request.url).encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest())
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, stream=stream, **kwargs)
+
+        path = self.entry_path(request)
+        entry = self.load(path)
+
+        if entry:
+            age, metadata, fp = entry
+
+            if age < self.ttl:
+                logger.debug('cached %s', request.url)
+                return self.build_cached_response(request, path, metadata, fp)
+
+            headers = CaseInsensitiveDict(metadata['headers'])
+            if 'ETag' in headers:
+                request.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                request.headers['If-Modified-Since'] = headers['Last-Modified']
+
+        # The session reads the content itself when not streaming
+        response = super().send(request, stream=True, **kwargs)
+
+        if entry:
+            if response.status_code == 304:
+                logger.debug('not modified %s', request.url)
+                response.close()
+                os.utime(path)
+                return self.build_cached_response(request, path, metadata, fp)
+            fp.close()
+
+        if response.status_code == 200:
+            return self.store(request, path, response)
+
+        return response
+
+    def load(self, path):
+        """Return an `(age, metadata, fp)` tuple, `fp` being positioned at the
+        start of the body, or None."""
+        try:
+            fp = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+
+        try:
+            metadata = json.loads(fp.readline().decode('utf-8'))
+        except ValueError:
+            metadata = None
+
+        if not metadata or metadata.get('version') != self.version:
+            fp.close()
+            return None
+
+        return time.time() - os.fstat(fp.fileno()).st_mtime, metadata, fp
+
+    def store(self, request, path, response):
+        """Return a response writing its body to the cache while it is read,
+        which is stored once the body is completely read."""
+        raw = response.raw
+        metadata = {
+            'version': self.version,
+            'url': request.url,
+            'status': raw.status,
+            'reason': raw.reason,
+            'headers': [
+                (name, value)
+                for name, value in raw.headers.items()
+                if name.lower() not in self.ignored_headers
+            ],
+        }
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        fp = os.fdopen(fd, 'wb')
+        fp.write(json.dumps(metadata).encode('utf-8') + b'\n')
+
+        # Keep the original response, which the session extracts cookies from
+        return self.build_cached_response(request, path, metadata,
+                                          TeeBody(raw, fp, tmp_path, path),
+                                          raw._original_response)
+
+    def build_cached_response(self, request, path, metadata, fp,
+                              original_response=None):
+        raw = HTTPResponse(body=fp,
+                           headers=metadata['headers'],
+                           status=metadata['status'],
+                           reason=metadata['reason'],
+                           preload_content=False,
+                           original_response=original_response)
+        response = self.build_response(request, raw)
+        response.cache_path = path
+        response.from_cache = original_response is None
+        return response
+
+
+class TeeBody(object):
+    """Body of a response being downloaded, copied to a temporary file which
+    replaces `path` once the body is completely read. Bodies are stored as
+    received, the response decoding them according to their
+    `Content-Encoding`."""
+
+    def __init__(self, raw, fp, tmp_path, path):
+        self._raw = raw
+        self._fp = fp
+        self._tmp_path = tmp_path
+        self._path = path
+        self._complete = False
+        self.closed = False
+
+    def read(self, amt=None):
+        try:
+            data = self._raw.read(amt, decode_content=False)
+            self._fp.write(data)
+        except BaseException:
+            self.close()
+            raise
+
+        if not data or amt is None:
+            self._complete = True
+            self.close()
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._raw.close()
+        self._fp.close()
+
+        if self._complete:
+            os.replace(self._tmp_path, self._path)
+        else:
+            logger.debug('incomplete body, not caching %s', self._path)
+            os.remove(self._tmp_path)
+
+
+def mount(session, path, ttl=0, **kwargs):
+    """Cache the responses of a requests session in the `path` directory."""
+    adapter = CachingAdapter(path, ttl, **kwargs)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return adapter
+
+
+def discard(response):
+    """Remove a response from the cache, for example when its content is
+    unexpected."""
+    path = getattr(response, 'cache_path', None)
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == '__main__':
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import collections
+    import gzip
+    import threading
+
+    import requests
+
+    hits = collections.Counter()
+
+    class Handler(BaseHTTPRequestHandler):
+
+        pages = {
+            '/etag': ({'ETag': '"v1"'}, b'balance: 42\n'),
+            '/modified': ({'Last-Modified': 'Mon, 05 Jan 2015 10:00:00 GMT'},
+                          b'modified\n'),
+            '/plain': ({}, b'plain\n'),
+            '/gzip': ({'Content-Encoding': 'gzip'},
+                      gzip.compress(b'line 1\nline 2\n')),
+        }
+
+        def do_GET(self):
+            path, _, _ = self.path.partition('?')
+            headers, body = self.pages[path]
+            hits[self.path] += 1
+
+            validators = (('If-None-Match', 'ETag'),
+                          ('If-Modified-Since', 'Last-Modified'))
+            if any(name in headers and
+                   self.headers.get(condition) == headers[name]
+                   for condition, name in validators):
+                hits['304'] += 1
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', len(body))
+            self.send_header('Set-Cookie', 'session=1')
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_POST = do_GET
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    root = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    with tempfile.TemporaryDirectory() as directory:
+        session = requests.Session()
+        adapter = mount(session, directory, ttl=60)
+
+        # Fresh responses are served from the cache
+        response = session.get(root + '/etag')
+        assert response.text == 'balance: 42\n'
+        assert not response.from_cache
+        assert session.cookies['session'] == '1'
+        response = session.get(root + '/etag')
+        assert response.text == 'balance: 42\n'
+        assert response.from_cache
+        assert hits['/etag'] == 1
+
+        # Parameters are part of the key
+        session.get(root + '/etag', params={'account': '1'})
+        session.get(root + '/etag', params={'account': '2'})
+        session.get(root + '/etag', params={'account': '1'})
+        assert hits['/etag?account=1'] == 1
+        assert hits['/etag?account=2'] == 1
+
+        # Streamed and compressed bodies
+        response = session.get(root + '/gzip', stream=True)
+        assert list(response.iter_lines()) == [b'line 1', b'line 2']
+        response = session.get(root + '/gzip', stream=True)
+        assert response.from_cache
+        assert list(response.iter_lines()) == [b'line 1', b'line 2']
+        assert hits['/gzip'] == 1
+
+        # Bodies are cached once completely read
+        response = session.get(root + '/plain', stream=True)
+        assert response.raw.read(2) == b'pl'
+        response.close()
+        assert hits['/plain'] == 1
+        response = session.get(root + '/plain', stream=True)
+        assert not response.from_cache
+        assert response.text == 'plain\n'
+        assert hits['/plain'] == 2
+        response = session.get(root + '/plain', stream=True)
+        assert response.from_cache
+        assert response.text == 'plain\n'
+
+        # Other methods are not cached
+        session.post(root + '/plain')
+        session.post(root + '/plain')
+        assert hits['/plain'] == 4
+
+        # Expired responses are revalidated
+        adapter.ttl = 0
+        assert session.get(root + '/etag').text == 'balance: 42\n'
+        assert session.get(root + '/modified').text == 'modified\n'
+        assert session.get(root + '/modified').text == 'modified\n'
+        assert hits['/etag'] == 2
+        assert hits['/modified'] == 2
+        assert hits['304'] == 2
+
+        # Or downloaded again without validators
+        session.get(root + '/plain')
+        session.get(root + '/plain')
+        assert hits['/plain'] == 6
+
+        # Discarded responses are downloaded again
+        adapter.ttl = 60
+        discard(session.get(root + '/etag'))
+        session.get(root + '/etag')
+        assert hits['/etag'] == 3
+        assert hits['304'] == 2
+
+    server.shutdown()
@@ -0,0 +1,80 @@
+"""Measure the start up time of the command line interface.
+
+Usage: python -m bank.importtime [-n RUNS] [ARGUMENTS...]
+
+Run `python -X importtime -m bank ARGUMENTS` once to list the slowest
+imports, then time RUNS cold starts of the command, compared to the start
+up of a bare interpreter.
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+
+def run(arguments, importtime=False):
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += arguments
+
+    start = time.perf_counter()
+    process = subprocess.run(command,
+                             stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE,
+                             universal_newlines=True)
+    return time.perf_counter() - start, process.stderr
+
+
+def parse_importtime(output):
+    """Iterate over `(module, depth, self_time, cumulative_time)` tuples, in
+    seconds, from the output of `python -X importtime`."""
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        self_time, cumulative_time, name = \
+            line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        yield name.strip(), depth, int(self_time) / 1e6, \
+            int(cumulative_time) / 1e6
+
+
+def median_time(arguments, runs):
+    return statistics.median(run(arguments)[0] for _ in range(runs))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Measure the start up time of bank')
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15,
+                        help='number of imports to list')
+    parser.add_argument('arguments', nargs=argparse.REMAINDER,
+                        help='bank command line [default: balances]')
+    options = parser.parse_args(argv)
+
+    if options.arguments[:1] == ['--']:
+        del options.arguments[0]
+    arguments = ['-m', 'bank'] + (options.arguments or ['balances'])
+    command_line = ' '.join(['bank'] + arguments[2:])
+
+    _, output = run(arguments, importtime=True)
+    imports = sorted((entry for entry in parse_importtime(output)
+                      if entry[1] == 0),
+                     key=lambda entry: entry[3],
+                     reverse=True)
+
+    print('Slowest imports of `{}`:'.format(command_line))
+    for name, _, _, cumulative_time in imports[:options.top]:
+        print('{:>8.1f}ms  {}'.format(cumulative_time * 1e3, name))
+
+    print('Median of {} cold starts:'.format(options.runs))
+    for label, timed_arguments in (('python', ['-c', 'pass']),
+                                   (command_line, arguments)):
+        print('{:>8.1f}ms  {}'.format(
+            median_time(timed_arguments, options.runs) * 1e3, label))
+
+
+if __name__ == '__main__':
+    main()
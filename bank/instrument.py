@@ -0,0 +1,272 @@
+"""Timers and counters around the hot paths: configuration parsing, SQL
+statements, adaptor calls, transaction storage and output formatting.
+
+Recording is disabled unless `start` is called, which the `--profile` option
+of the command line does. Instrumented code then only tests the module level
+`recorder`. Timers are aggregated by category and name, and every timed call
+is also kept as an event, to be exported as a trace viewable in Chrome's
+`about:tracing` or in Perfetto.
+"""
+import collections
+import functools
+import threading
+import time
+import types
+
+recorder = None
+
+
+class Timer(object):
+
+    __slots__ = ('category', 'name', 'count', 'rows', 'duration')
+
+    def __init__(self, category, name):
+        self.category = category
+        self.name = name
+        self.count = 0
+        self.rows = 0
+        self.duration = 0
+
+
+class Recorder(object):
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.timers = collections.OrderedDict()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def timer(self, category, name):
+        key = category, name
+        timer = self.timers.get(key)
+        if timer is None:
+            with self._lock:
+                timer = self.timers.setdefault(key, Timer(category, name))
+        return timer
+
+    def record(self, category, name, start, duration, rows=0):
+        """Record a call started at `start`, and return its event, which can
+        be updated while its rows are fetched."""
+        timer = self.timer(category, name)
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': (start - self.start_time) * 1e6,
+            'dur': duration * 1e6,
+            'pid': 0,
+            'tid': threading.get_ident(),
+            'args': {'rows': rows},
+        }
+
+        with self._lock:
+            timer.count += 1
+            timer.rows += rows
+            timer.duration += duration
+            self.events.append(event)
+
+        return event
+
+    def add_rows(self, category, name, event, duration, rows):
+        """Account for rows fetched after a recorded call."""
+        timer = self.timer(category, name)
+        with self._lock:
+            timer.rows += rows
+            timer.duration += duration
+            event['args']['rows'] += rows
+            event['dur'] += duration * 1e6
+
+    @property
+    def duration(self):
+        return time.perf_counter() - self.start_time
+
+    def summary(self):
+        """Return timers sorted by decreasing duration."""
+        return sorted(self.timers.values(),
+                      key=lambda timer: timer.duration,
+                      reverse=True)
+
+    def trace(self):
+        return {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+
+
+def start():
+    global recorder
+    recorder = Recorder()
+    return recorder
+
+
+def stop():
+    global recorder
+    stopped, recorder = recorder, None
+    return stopped
+
+
+class span(object):
+    """Time a block of code. Set `rows` on the span to count processed
+    items."""
+
+    __slots__ = ('category', 'name', 'rows', '_start')
+
+    def __init__(self, category, name):
+        self.category = category
+        self.name = name
+        self.rows = 0
+        self._start = None
+
+    def __enter__(self):
+        if recorder is not None:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._start is not None and recorder is not None:
+            recorder.record(self.category, self.name, self._start,
+                            time.perf_counter() - self._start, self.rows)
+
+
+def timed_iter(category, name, iterable):
+    """Time the production of the items of an iterable, recorded as a
+    single call once it is exhausted or closed."""
+    if recorder is None:
+        return iterable
+    return _timed_iter(recorder, category, name, iter(iterable))
+
+
+def _timed_iter(recorder, category, name, iterator):
+    first_start = time.perf_counter()
+    duration = 0
+    rows = 0
+
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                duration += time.perf_counter() - start
+            rows += 1
+            yield item
+    finally:
+        recorder.record(category, name, first_start, duration, rows)
+
+
+def instrumented(category, name, function):
+    """Wrap a function to time its calls. Returned generators are timed
+    separately, until exhausted."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if recorder is None:
+            return function(*args, **kwargs)
+
+        with span(category, name):
+            result = function(*args, **kwargs)
+
+        if isinstance(result, types.GeneratorType):
+            result = timed_iter(category, name + ' (iteration)', result)
+        return result
+
+    return wrapper
+
+
+def timed(category, name=None):
+    """Decorate a function to time its calls, named after its qualified name
+    by default."""
+    def decorator(function):
+        return instrumented(category, name or function.__qualname__, function)
+    return decorator
+
+
+def statement_name(sql):
+    return ' '.join(sql.split())
+
+
+class Cursor(object):
+    """Wrap a sqlite3 cursor to time statements, including the fetching of
+    their rows, and count fetched rows."""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._name = None
+        self._event = None
+        self._rows = 0
+        self._fetch_duration = 0
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def __del__(self):
+        self._flush()
+
+    def _flush(self):
+        """Account for the rows fetched since the last flush."""
+        if self._event is not None and recorder is not None and \
+                (self._rows or self._fetch_duration):
+            recorder.add_rows('sql', self._name, self._event,
+                              self._fetch_duration, self._rows)
+        self._rows = 0
+        self._fetch_duration = 0
+
+    def _execute(self, method, sql, parameters):
+        self._flush()
+
+        start = time.perf_counter()
+        method(sql, parameters)
+        duration = time.perf_counter() - start
+
+        self._name = statement_name(sql)
+        self._event = None
+        if recorder is not None:
+            self._event = recorder.record('sql', self._name, start, duration)
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._execute(self._cursor.execute, sql, parameters)
+
+    def executemany(self, sql, parameters):
+        self._execute(self._cursor.executemany, sql, parameters)
+        self._rows = max(self._cursor.rowcount, 0)
+        self._flush()
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = next(self._cursor)
+        except StopIteration:
+            self._fetch_duration += time.perf_counter() - start
+            self._flush()
+            raise
+        self._fetch_duration += time.perf_counter() - start
+        self._rows += 1
+        return row
+
+    def _fetch(self, method, *args):
+        start = time.perf_counter()
+        rows = method(*args)
+        self._fetch_duration += time.perf_counter() - start
+        return rows
+
+    def fetchone(self):
+        row = self._fetch(self._cursor.fetchone)
+        self._rows += row is not None
+        self._flush()
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._fetch(self._cursor.fetchmany, *args)
+        self._rows += len(rows)
+        self._flush()
+        return rows
+
+    def fetchall(self):
+        rows = self._fetch(self._cursor.fetchall)
+        self._rows += len(rows)
+        self._flush()
+        return rows
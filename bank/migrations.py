@@ -0,0 +1,210 @@
+"""Database schema migrations.
+
+Each migration upgrades the schema from the previous version to its own
+version, which is stored in the `user_version` pragma of the database. A
+migration is a function receiving a cursor. It runs inside a transaction,
+committed alongside the new schema version.
+
+Migrations touching large tables can be written as generators: the current
+transaction is committed each time they yield, so they can process rows by
+batches. Since the schema version is only updated once the last batch is
+done, batched migrations should be able to resume an interrupted run.
+"""
+
+from .balance import refresh_daily_balance
+from .searchindex import optimize
+
+
+class Migration(object):
+
+    def __init__(self, version, description, function):
+        self.version = version
+        self.description = description
+        self.function = function
+
+    def __repr__(self):
+        return 'Migration({version!r}, {description!r})'.format(
+            **self.__dict__)
+
+
+migrations = []
+
+
+def migration(description):
+    def decorator(function):
+        migrations.append(Migration(len(migrations) + 1,
+                                    description,
+                                    function))
+        return function
+    return decorator
+
+
+def iter_batches(cursor, table, batch_size=10000):
+    """Iterate over `(first_rowid, last_rowid)` ranges of a table containing
+    at most `batch_size` rows each."""
+    last = 0
+    while True:
+        first, last_of_batch = cursor.execute('''
+            SELECT MIN(rowid), MAX(rowid) FROM (
+                SELECT rowid FROM {}
+                WHERE rowid > ?
+                ORDER BY rowid
+                LIMIT ?
+            )'''.format(table), (last, batch_size)).fetchone()
+
+        if first is None:
+            break
+
+        yield first, last_of_batch
+        last = last_of_batch
+
+
+@migration('Create the initial schema')
+def create_initial_schema(cursor):
+    cursor.execute('''
+        CREATE TABLE "transaction" (
+            hash TEXT PRIMARY KEY,
+            account TEXT,
+            date TEXT,
+            id INTEGER,
+            type TEXT,
+            amount REAL,
+            description TEXT
+        )''')
+
+    cursor.execute('''
+        CREATE TABLE "account" (
+            id TEXT PRIMARY KEY,
+            balance_date TEXT,
+            balance_amount REAL
+        )''')
+
+    cursor.execute('''
+        CREATE VIRTUAL TABLE "transaction_search" USING fts4(
+            account,
+            type,
+            description
+        )''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS insert_transaction_trigger
+        AFTER INSERT ON "transaction"
+        BEGIN
+            INSERT OR IGNORE INTO "transaction_search" (
+                docid,
+                account,
+                type,
+                description
+            )
+            VALUES (
+                NEW.hash,
+                NEW.account,
+                NEW.type,
+                NEW.description
+            );
+        END''')
+
+
+@migration('Index transactions by account and date')
+def create_transaction_indexes(cursor):
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS transaction_account_date_index
+        ON "transaction" (account, date)''')
+
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS transaction_date_index
+        ON "transaction" (date)''')
+
+
+@migration('Store daily balances')
+def create_daily_balance(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_balance (
+            account TEXT,
+            date TEXT,
+            delta_sum REAL,
+            closing_balance REAL,
+            count INTEGER,
+            PRIMARY KEY (account, date)
+        ) WITHOUT ROWID''')
+
+    accounts = tuple(row[0] for row in cursor.execute(
+        'SELECT DISTINCT account FROM "transaction"'))
+
+    for account in accounts:
+        refresh_daily_balance(cursor, account)
+        yield
+
+
+@migration('Keep the search index in sync with transactions')
+def create_search_index_triggers(cursor):
+    cursor.execute('DROP TRIGGER IF EXISTS insert_transaction_trigger')
+
+    cursor.execute('''
+        CREATE TRIGGER insert_transaction_trigger
+        AFTER INSERT ON "transaction"
+        BEGIN
+            INSERT OR REPLACE INTO "transaction_search" (
+                docid,
+                account,
+                type,
+                description
+            )
+            VALUES (
+                NEW.hash,
+                NEW.account,
+                NEW.type,
+                NEW.description
+            );
+        END''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS delete_transaction_trigger
+        AFTER DELETE ON "transaction"
+        BEGIN
+            DELETE FROM "transaction_search"
+            WHERE docid = OLD.hash;
+        END''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS update_transaction_trigger
+        AFTER UPDATE OF hash, account, type, description ON "transaction"
+        BEGIN
+            DELETE FROM "transaction_search"
+            WHERE docid = OLD.hash;
+
+            INSERT OR REPLACE INTO "transaction_search" (
+                docid,
+                account,
+                type,
+                description
+            )
+            VALUES (
+                NEW.hash,
+                NEW.account,
+                NEW.type,
+                NEW.description
+            );
+        END''')
+
+    # Remove stale entries, and index missing transactions
+    cursor.execute('''
+        DELETE FROM "transaction_search"
+        WHERE docid NOT IN (SELECT hash FROM "transaction")''')
+
+    for first, last in iter_batches(cursor, '"transaction"'):
+        cursor.execute('''
+            INSERT INTO "transaction_search"
+                (docid, account, type, description)
+            SELECT hash, account, type, description
+            FROM "transaction"
+            WHERE rowid BETWEEN ? AND ?
+              AND NOT EXISTS (
+                  SELECT 1
+                  FROM "transaction_search"
+                  WHERE docid = "transaction".hash
+              )
+            ''', (first, last))
+        yield
+
+    optimize(cursor)
@@ -0,0 +1,46 @@
+"""Machine readable outputs for query commands.
+
+Rows, usually a sqlite3 cursor, are streamed to the output as they are
+fetched, without computing column widths or formatting each value in Python.
+"""
+import sys
+
+from . import instrument
+
+formats = ('table', 'csv', 'tsv', 'jsonl')
+
+
+def default_format(output=None):
+    """Tables are meant for humans, use TSV when writing to another
+    program."""
+    return 'table' if (output or sys.stdout).isatty() else 'tsv'
+
+
+def write_csv(labels, rows, output=None, dialect='excel'):
+    import csv
+    writer = csv.writer(output, dialect=dialect, lineterminator='\n')
+    writer.writerow(labels)
+    writer.writerows(rows)
+
+
+def write_tsv(labels, rows, output=None):
+    write_csv(labels, rows, output, dialect='excel-tab')
+
+
+def write_jsonl(labels, rows, output=None):
+    import json
+    keys = tuple(label.lower() for label in labels)
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    output.writelines(encode(dict(zip(keys, row))) + '\n' for row in rows)
+
+
+writers = {
+    'csv': write_csv,
+    'tsv': write_tsv,
+    'jsonl': write_jsonl,
+}
+
+
+@instrument.timed('format', 'output.write')
+def write(format, labels, rows, output=None):
+    writers[format](labels, rows, output or sys.stdout)
@@ -1,182 +1,224 @@
 from io import StringIO
+import collections
+import datetime
+import functools
 import re
-from pypeg2 import maybe_some, attr, List, some, Symbol, omit, parse, optional, separated
 
 __all__ = ['build']
 
 
-class MetaThing(type):
-
-    def __repr__(cls):
-        if hasattr(cls, '__class_repr__'):
-            return cls.__class_repr__(cls)
-        return cls.__name__
+keywords = {
+    'day': 'day',
+    'days': 'day',
+    'month': 'month',
+    'months': 'month',
+    'year': 'year',
+    'years': 'year',
+    'week': 'week',
+    'weeks': 'week',
+    'and': 'and',
+    'or': 'or',
+    'since': 'since',
+    'after': 'since',
+    'between': 'between',
+    'before': 'before',
+    'more': 'more',
+    'less': 'less',
+    'not': 'not',
+}
 
+time_units = ('day', 'week', 'month', 'year')
+
+
+Token = collections.namedtuple('Token', ('type', 'value', 'position'))
+
+
+# Alternatives are tried in order. Keywords and numbers must be followed by a
+# character that can't continue a word, else they are part of a word.
+token_re = re.compile(r'''
+\s*
+(?:
+    (?P<paren>[()])
+|
+    (?P<keyword>{keywords})\b(?![:\-])
+|
+    (?P<date>\d\d\d\d-\d\d-\d\d)(?![\w:*\\-])
+|
+    (?P<number>[+-]?\d+(?:\.\d+)?)(?![\w:*\\.-])
+|
+    (?P<word>
+        -?(?:\w+:)?                 # Field
+        ( [\w:*\\][\w:*\\-]*        # Simple words
+        |
+            (?:"
+                (?:[^"\n\r\\]       # Double quoted strings
+                |  ""
+                |  \\x[0-9a-fA-F]+
+                |  \\.
+                )*
+            "
+            |  '
+                (?:[^'\n\r\\]       # Single quoted strings
+                |  ''
+                |  \\x[0-9a-fA-F]+
+                |  \\.
+                )*
+            '
+            )
+        )
+    )
+)
+'''.format(keywords='|'.join(sorted(keywords, key=len, reverse=True))),
+    re.VERBOSE | re.IGNORECASE)
 
-class Thing(metaclass=MetaThing):
+trailing_space_re = re.compile(r'\s*$')
 
-    @property
-    def fts(self):
-        if isinstance(self, list):
-            return all(sub.fts for sub in self)
+plain_number_re = re.compile(r'-?\d+$')
 
-        return False
 
+def tokenize(query):
+    position = 0
+    end = trailing_space_re.search(query).start()
 
-expressions = []
+    while position < end:
+        match = token_re.match(query, position)
 
+        if not match:
+            raise SyntaxError('unexpected character {!r} at position {}'
+                              .format(query[position], position))
 
-class MetaExpression(MetaThing):
-    def __new__(cls, name, bases, dict):
-        result = super().__new__(cls, name, bases, dict)
-        if any(isinstance(c, cls) for c in bases):
-            expressions.append(result)
-        return result
+        type = match.lastgroup
+        value = match.group(type)
 
+        if type == 'keyword':
+            value = keywords[value.lower()]
 
-class Expression(Thing, metaclass=MetaExpression):
-    pass
+        yield Token(type, value, match.start(type))
+        position = match.end()
 
 
-def K(*_aliases):
+# Rough estimates used by the planner, as fractions of all transactions.
+# Without statistics, the ledger is assumed to span `ledger_days` up to today.
+ledger_days = 10 * 365
+word_selectivity = 0.05
+prefix_selectivity = 0.1
+field_selectivity = 0.3
+amount_selectivity = 0.5
 
-    class KSymbol(Symbol, Thing):
-        keyword = _aliases[0]
-        pattern = '|'.join(
-            r'\b{}\b'.format(''.join(
-                '[{}{}]'.format(char, char.upper())
-                for char in alias
-            ))
-            for alias in _aliases
-        )
-        regex = re.compile(pattern)
-
-        def __new__(cls, value):
-            return super().__new__(cls, cls.keyword)
-
-        def __str__(self):
-            return self.keyword
-
-        def __repr__(self):
-            return self.keyword
-
-        def __class_repr__(cls):
-            return cls.keyword
-
-    return KSymbol
-
-symbols = {
-    'day': K('day', 'days'),
-    'month': K('month', 'months'),
-    'year': K('year', 'years'),
-    'week': K('week', 'weeks'),
-    'and': K('and'),
-    'or': K('or'),
-    'since': K('since', 'after'),
-    'between': K('between'),
-    'before': K('before'),
-    'more': K('more'),
-    'less': K('less'),
-    'not': K('not'),
+unit_days = {
+    'day': 1,
+    'week': 7,
+    'month': 30,
+    'year': 365,
 }
 
-del K
 
+def days_until_today(date):
+    try:
+        date = datetime.date(*map(int, date.split('-')))
+    except ValueError:
+        return ledger_days // 2
+    return (datetime.date.today() - date).days
 
-number = re.compile('-?\d+(\.\d+)?')
 
+def days_selectivity(days):
+    return min(max(days / ledger_days, 1 / ledger_days), 1.0)
 
-class BooleanOperator(str, Thing):
-    grammar = [symbols['or'], symbols['and']]
+
+class Expression(object):
 
     def build(self, builder):
-        builder.add(self)
-
-
-class TimeUnit(str, Thing):
-    grammar = [
-        symbols['day'],
-        symbols['week'],
-        symbols['month'],
-        symbols['year'],
-    ]
-
-
-class Word(str, Thing):
-    word_re = r'''
-    (?!{keywords_re})           # Ignore keywords
-    -?(?:\w+:)?                 # Field
-    ( [\w:*\\][\w:*\\-]*        # Simple words
-    |
-        (?:"
-            (?:[^"\n\r\\]       # Double quoted strings
-            |  ""
-            |  \\x[0-9a-fA-F]+
-            |  \\.
-            )*
-        "
-        |  '
-            (?:[^'\n\r\\]       # Single quoted strings
-            |  ''
-            |  \\x[0-9a-fA-F]+
-            |  \\.
-            )*
-        '
-        )
-    )
-    '''.format(keywords_re='|'.join(s.pattern for s in symbols.values()))
+        raise NotImplementedError()
+
+    def selectivity(self):
+        """Estimated fraction of the transactions matching the expression."""
+        return 1.0
+
 
-    grammar = re.compile(word_re, re.VERBOSE)
+class DateExpression(Expression):
 
-    del word_re
+    # Cleared by the planner when the date index shouldn't drive the query
+    use_index = True
 
+    # Whether the selectivity is estimated against today's date
+    absolute = True
+
+    @property
+    def column(self):
+        return 'date' if self.use_index else '+date'
 
-class Date(str, Thing):
-    grammar = re.compile(r'\d\d\d\d-\d\d-\d\d')
 
+class BooleanExpression(Expression):
 
-class Query(List, Thing):
-    grammar = expressions, maybe_some(optional(BooleanOperator), expressions)
+    def __init__(self, operator, left, right):
+        # 'AND' when implicit, or the keyword used in the query
+        self.operator = operator
+        self.left = left
+        self.right = right
 
     def build(self, builder):
-        previous = None
-        for thing in self:
-            if previous and \
-                    not isinstance(previous, BooleanOperator) and \
-                    not isinstance(thing, BooleanOperator):
-                builder.add('AND')
-            thing.build(builder)
-            previous = thing
+        self.left.build(builder)
+        builder.add(self.operator)
+        self.right.build(builder)
+
+    @property
+    def is_and(self):
+        return self.operator.lower() == 'and'
+
+    def selectivity(self):
+        left = self.left.selectivity()
+        right = self.right.selectivity()
+        if self.is_and:
+            return left * right
+        return min(left + right, 1.0)
+
 
+class AfterDateExpression(DateExpression):
 
-class AfterDateExpression(Expression, str):
-    grammar = omit(symbols['since']), Date
+    def __init__(self, date):
+        self.date = date
 
     def build(self, builder):
-        builder.add('''date >= ?''', self)
+        builder.add('''{} >= ?'''.format(self.column), self.date)
 
+    def selectivity(self):
+        return days_selectivity(days_until_today(self.date))
 
-class BeforeDateExpression(Expression, str):
-    grammar = omit(symbols['before']), Date
+
+class BeforeDateExpression(DateExpression):
+
+    def __init__(self, date):
+        self.date = date
 
     def build(self, builder):
-        builder.add('''date <= ?''', self)
+        builder.add('''{} <= ?'''.format(self.column), self.date)
+
+    def selectivity(self):
+        return days_selectivity(ledger_days - days_until_today(self.date))
 
 
-class BetweenDateExpression(Expression):
-    grammar = \
-        omit(symbols['between']), attr('min', Date), \
-        omit(symbols['and']), attr('max', Date)
+class BetweenDateExpression(DateExpression):
+
+    def __init__(self, min, max):
+        self.min = min
+        self.max = max
 
     def build(self, builder):
-        builder.add('''(date >= ? AND date <= ?)''', self.min, self.max)
+        builder.add('''({0} >= ? AND {0} <= ?)'''.format(self.column),
+                    self.min, self.max)
+
+    def selectivity(self):
+        return days_selectivity(
+            days_until_today(self.min) - days_until_today(self.max))
 
 
-class RelativeDateExpression(Expression):
-    grammar = \
-        omit(symbols['since']), \
-        attr('length', number), \
-        attr('unit', TimeUnit)
+class RelativeDateExpression(DateExpression):
+
+    absolute = False
+
+    def __init__(self, length, unit):
+        self.length = length
+        self.unit = unit
 
     def build(self, builder):
         unit = self.unit
@@ -186,15 +228,19 @@ class RelativeDateExpression(Expression):
             length *= 7
             unit = 'day'
 
-        builder.add('''date >= DATE('now', '{} {}')'''.format(length, unit))
+        builder.add('''{} >= DATE('now', ?)'''.format(self.column),
+                    '{} {}'.format(length, unit))
+
+    def selectivity(self):
+        return days_selectivity(int(self.length) * unit_days[self.unit])
 
 
 class AmountExpression(Expression):
-    grammar = \
-        attr('cmp', [symbols['more'], symbols['less']]), \
-        optional('than'), \
-        attr('sign', re.compile(r'[+-]?')), \
-        attr('value', number)
+
+    def __init__(self, cmp, sign, value):
+        self.cmp = cmp
+        self.sign = sign
+        self.value = value
 
     def build(self, builder):
         operator = '>=' if self.cmp == 'more' else '<='
@@ -206,36 +252,342 @@ class AmountExpression(Expression):
 
         builder.add('{} {} ?'.format(amount, operator), value)
 
+    def selectivity(self):
+        return amount_selectivity
+
+
+class NotExpression(Expression):
 
-class NotExpression(Expression, List):
-    grammar = omit(symbols['not']), expressions
+    def __init__(self, expression):
+        self.expression = expression
 
     def build(self, builder):
         builder.add('NOT (')
-        self[0].build(builder)
+        self.expression.build(builder)
         builder.add(')')
 
+    def selectivity(self):
+        return 1.0 - self.expression.selectivity()
 
-class GroupExpression(Query):
-    grammar = '(', Query.grammar, ')'
+
+class GroupExpression(Expression):
+
+    def __init__(self, expression):
+        self.expression = expression
 
     def build(self, builder):
         builder.add('(')
-        super().build(builder)
+        self.expression.build(builder)
         builder.add(')')
 
+    def selectivity(self):
+        return self.expression.selectivity()
+
+
+class WordsExpression(Expression):
+
+    # When set, the full text search drives the query: matching docids are
+    # looked up in the primary key, which needs them as text. Else the search
+    # only filters rows found through another index.
+    use_index = True
 
-class WordsExpression(Expression, List):
-    grammar = separated(some(Word))
+    def __init__(self, words):
+        self.words = words
 
     def build(self, builder):
-        builder.add('''
+        if self.use_index:
+            template = '''
             hash IN (
+                SELECT CAST(docid AS TEXT)
+                FROM transaction_search
+                WHERE description
+                MATCH ?
+            )'''
+        else:
+            template = '''
+            +hash IN (
                 SELECT docid
                 FROM transaction_search
                 WHERE description
                 MATCH ?
-            )''', ' '.join(self))
+            )'''
+        builder.add(template, ' '.join(self.words))
+
+    def selectivity(self):
+        selectivity = 1.0
+        for word in self.words:
+            if word.startswith('-'):
+                continue
+            elif ':' in word.split('"')[0].split("'")[0]:
+                selectivity *= field_selectivity
+            elif word.endswith('*'):
+                selectivity *= prefix_selectivity
+            else:
+                selectivity *= word_selectivity
+        return selectivity
+
+
+class Parser(object):
+    """Precedence climbing parser. Operators, from the loosest to the
+    tightest: `or`, `and` (explicit or implicit) and `not`."""
+
+    binary_precedences = {
+        'or': 1,
+        'and': 2,
+    }
+
+    def __init__(self, query):
+        self.tokens = tuple(tokenize(query))
+        self.index = 0
+
+    @property
+    def token(self):
+        if self.index < len(self.tokens):
+            return self.tokens[self.index]
+
+    def advance(self):
+        token = self.token
+        self.index += 1
+        return token
+
+    def error(self, expected):
+        token = self.token
+        if token:
+            message = 'unexpected {!r} at position {}, expecting {}'.format(
+                token.value, token.position, expected)
+        else:
+            message = 'unexpected end of query, expecting {}'.format(expected)
+        return SyntaxError(message)
+
+    def is_keyword(self, *values):
+        token = self.token
+        return token is not None and \
+            token.type == 'keyword' and \
+            token.value in values
+
+    def expect(self, type, *values):
+        token = self.token
+        if token is None or token.type != type or \
+                (values and token.value not in values):
+            raise self.error(' or '.join(values) if values else type)
+        return self.advance()
+
+    def parse(self):
+        expression = self.parse_expression(1)
+        if self.token is not None:
+            raise self.error('an operator or an expression')
+        return expression
+
+    def parse_expression(self, min_precedence):
+        left = self.parse_unary()
+
+        while True:
+            token = self.token
+
+            if token is None or (token.type == 'paren' and
+                                 token.value == ')'):
+                break
+
+            if token.type == 'keyword' and token.value in ('and', 'or'):
+                operator = token.value
+                precedence = self.binary_precedences[operator]
+                implicit = False
+            else:
+                operator = 'AND'
+                precedence = self.binary_precedences['and']
+                implicit = True
+
+            if precedence < min_precedence:
+                break
+
+            if not implicit:
+                self.advance()
+
+            right = self.parse_expression(precedence + 1)
+            left = BooleanExpression(operator, left, right)
+
+        return left
+
+    def parse_unary(self):
+        if self.is_keyword('not'):
+            self.advance()
+            return NotExpression(self.parse_unary())
+
+        token = self.token
+
+        if token is None:
+            raise self.error('an expression')
+
+        if token.type == 'paren' and token.value == '(':
+            self.advance()
+            expression = self.parse_expression(1)
+            self.expect('paren', ')')
+            return GroupExpression(expression)
+
+        if token.type == 'keyword':
+            if token.value == 'since':
+                return self.parse_since()
+            if token.value == 'before':
+                self.advance()
+                return BeforeDateExpression(self.expect('date').value)
+            if token.value == 'between':
+                self.advance()
+                min = self.expect('date').value
+                self.expect('keyword', 'and')
+                return BetweenDateExpression(min, self.expect('date').value)
+            if token.value in ('more', 'less'):
+                return self.parse_amount()
+
+        return self.parse_words()
+
+    def parse_since(self):
+        self.advance()
+        token = self.token
+
+        if token is not None and token.type == 'date':
+            self.advance()
+            return AfterDateExpression(token.value)
+
+        length = self.expect('number').value
+        if length.startswith('+'):
+            raise self.error('a number')
+
+        unit = self.expect('keyword', *time_units).value
+        return RelativeDateExpression(length, unit)
+
+    def parse_amount(self):
+        cmp = self.advance().value
+
+        token = self.token
+        if token is not None and token.type == 'word' and \
+                token.value == 'than':
+            self.advance()
+
+        number = self.expect('number').value
+        sign = number[0] if number[0] in '+-' else ''
+
+        return AmountExpression(cmp, sign, number.lstrip('+-'))
+
+    def parse_words(self):
+        words = []
+
+        while True:
+            token = self.token
+
+            if token is None:
+                break
+
+            if token.type in ('word', 'date') or \
+                    (token.type == 'number' and
+                     plain_number_re.match(token.value)):
+                words.append(token.value)
+                self.advance()
+            else:
+                break
+
+        if not words:
+            raise self.error('an expression')
+
+        return WordsExpression(words)
+
+
+def parse(query):
+    return Parser(query).parse()
+
+
+def iter_conjuncts(expression):
+    """Flatten a chain of AND, including parenthesized ones."""
+    if isinstance(expression, BooleanExpression) and expression.is_and:
+        yield from iter_conjuncts(expression.left)
+        yield from iter_conjuncts(expression.right)
+    elif isinstance(expression, GroupExpression):
+        inner = tuple(iter_conjuncts(expression.expression))
+        if len(inner) > 1 or not isinstance(inner[0], BooleanExpression):
+            yield from inner
+        else:
+            yield expression
+    else:
+        yield expression
+
+
+def iter_expressions(expression):
+    yield expression
+    if isinstance(expression, BooleanExpression):
+        yield from iter_expressions(expression.left)
+        yield from iter_expressions(expression.right)
+    elif isinstance(expression, (NotExpression, GroupExpression)):
+        yield from iter_expressions(expression.expression)
+
+
+def plan_depends_on_today(query):
+    """Whether the plan of a query depends on the current date, which is the
+    case of absolute dates. Their statements shouldn't be kept across
+    days."""
+    return any(isinstance(expression, DateExpression) and expression.absolute
+               for expression in iter_expressions(parse(query)))
+
+
+def conjunct_rank(expression):
+    if isinstance(expression, DateExpression):
+        return 0
+    if isinstance(expression, WordsExpression):
+        return 1
+    if isinstance(expression, AmountExpression):
+        return 2
+    return 3
+
+
+def plan(expression):
+    """Reorder the predicates of an expression so that SQLite uses the
+    most selective index.
+
+    Conjuncts are sorted with date ranges first, then full text searches
+    (which includes `account:` and `type:` fields), then the rest, each by
+    estimated selectivity. When both a date range and a full text search are
+    present, only the most selective one is allowed to drive the query: the
+    other one is emitted so that it can only filter rows.
+    """
+    conjuncts = [plan_conjunct(conjunct)
+                 for conjunct in iter_conjuncts(expression)]
+
+    if len(conjuncts) == 1:
+        return conjuncts[0]
+
+    conjuncts.sort(key=lambda conjunct: (conjunct_rank(conjunct),
+                                         conjunct.selectivity()))
+
+    dates = [conjunct for conjunct in conjuncts
+             if isinstance(conjunct, DateExpression)]
+    words = [conjunct for conjunct in conjuncts
+             if isinstance(conjunct, WordsExpression)]
+
+    if dates and words:
+        if dates[0].selectivity() <= words[0].selectivity():
+            for conjunct in words:
+                conjunct.use_index = False
+        else:
+            for conjunct in dates:
+                conjunct.use_index = False
+
+    result = conjuncts[0]
+    for conjunct in conjuncts[1:]:
+        result = BooleanExpression('AND', result, conjunct)
+
+    if isinstance(expression, GroupExpression):
+        result = GroupExpression(result)
+    return result
+
+
+def plan_conjunct(expression):
+    if isinstance(expression, BooleanExpression):
+        return BooleanExpression(expression.operator,
+                                 plan(expression.left),
+                                 plan(expression.right))
+    if isinstance(expression, NotExpression):
+        return NotExpression(plan(expression.expression))
+    if isinstance(expression, GroupExpression):
+        return GroupExpression(plan(expression.expression))
+    return expression
 
 
 class StatementBuilder(object):
@@ -257,11 +609,134 @@ class StatementBuilder(object):
         return tuple(self._arguments)
 
 
-def build(query):
+@functools.lru_cache(maxsize=256)
+def build(query, planned=True):
     builder = StatementBuilder()
-    parse(query, Query).build(builder)
+    expression = parse(query)
+    if planned:
+        expression = plan(expression)
+    expression.build(builder)
     return builder.statement, builder.arguments
 
+
 if __name__ == '__main__':
     import sys
-    print(*build(sys.argv[1]))
+    import time
+
+    if len(sys.argv) > 1:
+        print(*build(sys.argv[1]))
+        sys.exit()
+
+    # Expected results of the README queries, as built by the previous
+    # pypeg2 based parser, except for the two grouping cases below. W stands
+    # for the full text search condition, and F for the full text search
+    # filter.
+    def words_condition(use_index):
+        builder = StatementBuilder()
+        expression = WordsExpression(())
+        expression.use_index = use_index
+        expression.build(builder)
+        return ' '.join(builder.statement.split())
+
+    def test(query, statement, arguments, planned=False):
+        result_statement, result_arguments = build(query, planned)
+        result_statement = ' '.join(result_statement.split()) \
+            .replace(words_condition(True), 'W') \
+            .replace(words_condition(False), 'F')
+        if (result_statement, result_arguments) != (statement, arguments):
+            raise AssertionError('\n{!r}\n{!r} {!r}\n!=\n{!r} {!r}'.format(
+                query, result_statement, result_arguments, statement,
+                arguments))
+
+    test('gittip',
+         'W',
+         ('gittip',))
+    test('paypal or amazon',
+         'W or W',
+         ('paypal', 'amazon'))
+    test('sncf or "capitaine train"',
+         'W or W',
+         ('sncf', '"capitaine train"'))
+    test('volt*',
+         'W',
+         ('volt*',))
+    test('type:loan',
+         'W',
+         ('type:loan',))
+    test('since 2014-02-03',
+         'date >= ?',
+         ('2014-02-03',))
+    test('since 10 days',
+         "date >= DATE('now', ?)",
+         ('-10 day',))
+    test('before 2014-02-03',
+         'date <= ?',
+         ('2014-02-03',))
+    test('between 2014-01-01 and 2014-01-31',
+         '(date >= ? AND date <= ?)',
+         ('2014-01-01', '2014-01-31'))
+    test('more than 1000',
+         'ABS(amount) >= ?',
+         (1000.0,))
+    test('more than +1000',
+         'amount >= ?',
+         (1000.0,))
+    test('less than -1000',
+         'amount <= ?',
+         (-1000.0,))
+    test('gittip since 10 days',
+         "W AND date >= DATE('now', ?)",
+         ('gittip', '-10 day'))
+    test('amazon more than +0',
+         'W AND amount >= ?',
+         ('amazon', 0.0))
+    test('not account:xxx or since 10 days',
+         "NOT ( W ) or date >= DATE('now', ?)",
+         ('account:xxx', '-10 day'))
+
+    # These intentionally differ: pypeg2 rejected a group followed by an
+    # implicit and, and built a single NOT from a double negation
+    test('(paypal or amazon) sncf',
+         '( W or W ) AND W',
+         ('paypal', 'amazon', 'sncf'))
+    test('not not amazon',
+         'NOT ( NOT ( W ) )',
+         ('amazon',))
+
+    # Planned queries
+    test('more than 100 amazon between 2014-01-01 and 2014-01-31',
+         '(date >= ? AND date <= ?) AND F AND ABS(amount) >= ?',
+         ('2014-01-01', '2014-01-31', 'amazon', 100.0),
+         planned=True)
+    test('account:xxx since 5 years',
+         "+date >= DATE('now', ?) AND W",
+         ('-5 year', 'account:xxx'),
+         planned=True)
+    test('amazon since 1 year account:xxx',
+         "+date >= DATE('now', ?) AND W AND W",
+         ('-1 year', 'amazon', 'account:xxx'),
+         planned=True)
+    test('(amazon (since 10 days)) or (sncf (more than 10 since 2 years))',
+         "( date >= DATE('now', ?) AND F ) or "
+         "( +date >= DATE('now', ?) AND W AND ABS(amount) >= ? )",
+         ('-10 day', 'amazon', '-2 year', 'sncf', 10.0),
+         planned=True)
+
+    assert not plan_depends_on_today('amazon since 2 months')
+    assert plan_depends_on_today('amazon since 2014-01-01')
+    assert plan_depends_on_today('sncf or not (amazon before 2014-01-01)')
+
+    queries = (
+        'gittip since 10 days',
+        'not account:xxx or since 10 days',
+        ' or '.join('word{0} since 2014-01-01 more than +{0}'.format(index)
+                    for index in range(30)),
+    )
+
+    for query in queries:
+        count = 1000
+        start = time.time()
+        for _ in range(count):
+            build.__wrapped__(query, True)
+        duration = (time.time() - start) / count
+        print('{:>8.1f}µs {}'.format(duration * 1e6, query[:60]))
@@ -0,0 +1,72 @@
+"""Persistent cache of compiled search queries, enabled by `query_cache`.
+
+Relative dates are computed by SQLite, so compiled queries stay valid over
+time. Queries with absolute dates aren't cached though, since their plan
+depends on the current date. The `ql` module is only imported when a query is
+not cached, sparing its import and parsing cost.
+"""
+import collections
+import json
+import logging
+
+from .util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCache(object):
+
+    # Bump this when the `ql` output changes, to drop stale entries
+    version = 4
+
+    max_size = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as fp:
+                content = json.load(fp,
+                                    object_pairs_hook=collections.OrderedDict)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning('Ignoring invalid query cache %s', self.path)
+            return
+
+        if content.get('version') == self.version:
+            self._entries = content['queries']
+
+    def build(self, query):
+        entry = self._entries.get(query)
+
+        if entry is None:
+            from . import ql
+            statement, arguments = ql.build(query)
+            if ql.plan_depends_on_today(query):
+                return statement, arguments
+
+            entry = self._entries[query] = [statement, list(arguments)]
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._dirty = True
+        else:
+            # Recently used queries are saved in this order with the next new
+            # one, but reordering alone isn't worth writing the file
+            self._entries.move_to_end(query)
+
+        statement, arguments = entry
+        return statement, tuple(arguments)
+
+    def save(self):
+        if not self._dirty:
+            return
+
+        with atomic_write(self.path, encoding='utf-8') as fp:
+            json.dump({'version': self.version, 'queries': self._entries}, fp)
+        self._dirty = False
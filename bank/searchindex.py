@@ -0,0 +1,44 @@
+"""Maintenance of the `transaction_search` full text index.
+
+The index is kept in sync with the `transaction` table by triggers. Bulk
+changes leave the index split in many small segments, which slows searches
+down until they are merged together.
+"""
+
+
+def reindex(cursor, since=''):
+    """Rebuild index entries of transactions from the `since` date (a
+    formatted date string) onwards."""
+
+    if since:
+        cursor.execute('''
+            DELETE FROM "transaction_search"
+            WHERE docid IN (
+                SELECT hash
+                FROM "transaction"
+                WHERE date >= ?
+            )''', (since,))
+    else:
+        cursor.execute('DELETE FROM "transaction_search"')
+
+    cursor.execute('''
+        INSERT OR REPLACE INTO "transaction_search"
+            (docid, account, type, description)
+        SELECT hash, account, type, description
+        FROM "transaction"
+        WHERE date >= ?''', (since,))
+
+
+def merge(cursor, pages=200):
+    """Merge some index segments together, doing about `pages` pages of
+    work."""
+    cursor.execute('''
+        INSERT INTO "transaction_search" ("transaction_search")
+        VALUES ('merge={:d},8')'''.format(pages))
+
+
+def optimize(cursor):
+    """Merge all index segments into a single one."""
+    cursor.execute('''
+        INSERT INTO "transaction_search" ("transaction_search")
+        VALUES ('optimize')''')
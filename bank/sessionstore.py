@@ -0,0 +1,161 @@
+"""Cookies of adaptor sessions, kept between runs to spare a login.
+
+Cookies are encrypted with a key derived from the session credentials, using
+the optional `cryptography` package. Without it, nothing is stored: cookies
+are never written in clear. A store which can't be decrypted, because the
+credentials changed, is ignored and replaced.
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+
+from .util import atomic_write
+
+logger = logging.getLogger(__name__)
+
+# Stored cookie attributes, as accepted by `requests.cookies.create_cookie`
+cookie_attributes = ('name', 'value', 'domain', 'path', 'secure', 'expires')
+
+
+def create(directory, name, *credentials):
+    """Return the store of the session `name`, or None when encryption is
+    not available."""
+    try:
+        import cryptography.fernet  # noqa
+    except ImportError:
+        logger.info('Install cryptography to keep sessions between runs')
+        return None
+
+    os.makedirs(directory, exist_ok=True)
+    filename = hashlib.sha1(name.encode('utf-8')).hexdigest() + '.json'
+    secret = '\0'.join(credentials).encode('utf-8')
+    return CookieStore(os.path.join(directory, filename), secret)
+
+
+class CookieStore(object):
+
+    version = 1
+    iterations = 100000
+
+    def __init__(self, path, secret):
+        self.path = path
+        self._secret = secret
+        self._salt = None
+        self._fernet = None
+        self._saved = None
+
+    def _get_fernet(self, salt):
+        if self._fernet is None or salt != self._salt:
+            from cryptography.fernet import Fernet
+            key = hashlib.pbkdf2_hmac('sha256', self._secret, salt,
+                                      self.iterations)
+            self._salt = salt
+            self._fernet = Fernet(base64.urlsafe_b64encode(key))
+        return self._fernet
+
+    def load(self, jar):
+        """Add the stored cookies to a cookie jar. Return whether some
+        were."""
+        from cryptography.fernet import InvalidToken
+        from requests.cookies import create_cookie
+
+        try:
+            with open(self.path, encoding='utf-8') as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return False
+        except ValueError:
+            logger.warning('Ignoring invalid session store %s', self.path)
+            return False
+
+        if data.get('version') != self.version:
+            return False
+
+        fernet = self._get_fernet(base64.b64decode(data['salt']))
+        try:
+            cookies = json.loads(fernet.decrypt(data['token'].encode('ascii'))
+                                 .decode('utf-8'))
+        except InvalidToken:
+            logger.info('Ignoring session store %s, encrypted with other '
+                        'credentials', self.path)
+            return False
+
+        for cookie in cookies:
+            jar.set_cookie(create_cookie(**cookie))
+
+        self._saved = cookies
+        return bool(cookies)
+
+    def save(self, jar):
+        """Store the cookies of a cookie jar, if they changed."""
+        cookies = [
+            {attribute: getattr(cookie, attribute)
+             for attribute in cookie_attributes}
+            for cookie in jar
+            if not cookie.is_expired()
+        ]
+
+        if cookies == self._saved:
+            return
+
+        salt = self._salt or os.urandom(16)
+        token = self._get_fernet(salt).encrypt(
+            json.dumps(cookies).encode('utf-8'))
+
+        with atomic_write(self.path, encoding='utf-8') as fp:
+            json.dump({
+                'version': self.version,
+                'salt': base64.b64encode(salt).decode('ascii'),
+                'token': token.decode('ascii'),
+            }, fp)
+
+        self._saved = cookies
+
+    def clear(self):
+        self._saved = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    import requests
+
+    with tempfile.TemporaryDirectory() as directory:
+        jar = requests.cookies.RequestsCookieJar()
+        jar.set('session', 'abc', domain='example.com', path='/')
+
+        store = create(directory, 'my session', 'fred', 'xxx')
+        assert not store.load(requests.cookies.RequestsCookieJar())
+        store.save(jar)
+
+        with open(store.path) as fp:
+            assert 'abc' not in fp.read()
+        assert os.stat(store.path).st_mode & 0o777 == 0o600
+
+        restored = requests.cookies.RequestsCookieJar()
+        store = create(directory, 'my session', 'fred', 'xxx')
+        assert store.load(restored)
+        assert restored.get('session', domain='example.com') == 'abc'
+
+        # Unchanged cookies are not written again
+        mtime = os.stat(store.path).st_mtime_ns
+        store.save(restored)
+        assert os.stat(store.path).st_mtime_ns == mtime
+
+        # Other credentials can't read the store
+        store = create(directory, 'my session', 'fred', 'yyy')
+        assert not store.load(requests.cookies.RequestsCookieJar())
+
+        # Each session has its own store
+        store = create(directory, 'other session', 'fred', 'xxx')
+        assert not store.load(requests.cookies.RequestsCookieJar())
+
+        store = create(directory, 'my session', 'fred', 'xxx')
+        store.clear()
+        assert not store.load(requests.cookies.RequestsCookieJar())
@@ -0,0 +1,67 @@
+"""Aggregates of the transactions matching a search, computed by SQLite.
+
+Only the summary rows are fetched, whatever the number of matching
+transactions.
+"""
+
+aggregates = {
+    'sum': 'ROUND(TOTAL(amount), 2)',
+    'count': 'COUNT(*)',
+    'min': 'MIN(amount)',
+    'max': 'MAX(amount)',
+    'avg': 'ROUND(AVG(amount), 2)',
+}
+
+groupings = {
+    'account': 'account',
+    'type': 'type',
+    'month': 'SUBSTR(date, 1, 7)',
+}
+
+
+def create_aggregates(value):
+    """Parse a comma separated list of aggregate names."""
+    names = tuple(name.strip().lower() for name in value.split(','))
+    for name in names:
+        if name not in aggregates:
+            raise ValueError('unknown aggregate {!r}, expecting one of {}'
+                             .format(name, ', '.join(sorted(aggregates))))
+    return names
+
+
+def total(cursor, statement, arguments=()):
+    """Sum the amounts of the transactions matching a search statement."""
+    return cursor.execute('''
+        SELECT TOTAL(amount)
+        FROM "transaction"
+        WHERE {}
+        '''.format(statement), arguments).fetchone()[0]
+
+
+def summarize(cursor, statement, arguments=(), group_by=None,
+              names=('sum', 'count')):
+    """Compute the aggregates `names` of the transactions matching a search
+    statement, for each value of the `group_by` grouping if any. Return an
+    iterator over rows starting with the group value."""
+
+    columns = ', '.join(aggregates[name] for name in names)
+
+    if group_by:
+        query = '''
+            SELECT {grouping} AS "group", {columns}
+            FROM "transaction"
+            WHERE {statement}
+            GROUP BY "group"
+            ORDER BY "group"
+            '''
+    else:
+        query = '''
+            SELECT 'all', {columns}
+            FROM "transaction"
+            WHERE {statement}
+            '''
+
+    return cursor.execute(query.format(
+        grouping=groupings.get(group_by),
+        columns=columns,
+        statement=statement), arguments)
@@ -5,6 +5,8 @@ import textwrap
 import itertools
 import io
 
+from . import instrument
+
 
 def rindex(list, needle):
     return next(index
@@ -41,6 +43,7 @@ class TableFormatterWorker(object):
         self._lines_written = 0
         self._first_rows = ()
         self._column_widths = ()
+        self._buffer = []
 
     def _compute_widths(self):
         rows = self._collect_rows_for_width()
@@ -138,69 +141,92 @@ class TableFormatterWorker(object):
             len(self.formatter.vertical_separator) * (len(self.columns) - 1) +\
             len(self.formatter.external_vertical_separator) * 2
 
+    def _compile_templates(self):
+        """Precompile the format of a whole line from the column widths."""
+        def template(header):
+            cells = (
+                '{}{{:{}{}}}{}'.format(
+                    column.left_margin * ' ',
+                    column.align_header if header else column.align,
+                    width,
+                    column.right_margin * ' ')
+                for column, width in zip(self.columns, self._column_widths))
+            return '{0}{1}{0}\n'.format(
+                self.formatter.external_vertical_separator.replace(
+                    '{', '{{').replace('}', '}}'),
+                self.formatter.vertical_separator.replace(
+                    '{', '{{').replace('}', '}}').join(cells))
+
+        self._row_template = template(False)
+        self._header_template = template(True)
+        width = self._compute_extra_width() + sum(self._column_widths)
+        self._line = width * '-' + '\n'
+
     def write(self, str):
-        self._lines_written += str.count('\n')
-        self.output.write(str)
+        self._write(str, str.count('\n'))
+
+    def _write(self, str, lines):
+        self._lines_written += lines
+        self._buffer.append(str)
+        if len(self._buffer) >= self.formatter.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.output.write(''.join(self._buffer))
+        self._buffer = []
 
     def write_line(self):
-        width = self._compute_extra_width() + sum(self._column_widths)
-        self.write(width * '-')
-        self.write('\n')
+        self._write(self._line, 1)
 
     def write_row(self, values, header=False):
-        wraped_values = []
-        for (index, column), value in zip(enumerate(self.columns), values):
-            width = self._column_widths[index]
-            value = str(value)
-            if len(value) > width:
-                wraped_values.append(textwrap.wrap(value, width=width))
-            else:
-                wraped_values.append((value,))
+        template = self._header_template if header else self._row_template
+        values = [str(value) for value in values]
 
-        for line in itertools.zip_longest(*wraped_values):
-            first = True
-            for (index, column), cell in zip(enumerate(self.columns), line):
-                if first:
-                    first = False
-                    self.write(self.formatter.external_vertical_separator)
-                else:
-                    self.write(self.formatter.vertical_separator)
+        # Values fitting in their column don't widen the line. They may still
+        # span several lines if they contain newlines.
+        line = template.format(*values)
+        if len(line) == len(self._line):
+            self._write(line, line.count('\n'))
+            return
 
-                align = column.align_header if header else column.align
+        wraped_values = [
+            textwrap.wrap(value, width=width) if len(value) > width
+            else (value,)
+            for value, width in zip(values, self._column_widths)]
 
-                self.write('{}{:{}{}}{}'.format(
-                    column.left_margin * ' ',
-                    cell or '',
-                    align,
-                    self._column_widths[index],
-                    column.right_margin * ' '))
-
-            self.write(self.formatter.external_vertical_separator)
-            self.write('\n')
+        lines = ''.join(template.format(*(cell or '' for cell in line))
+                        for line in itertools.zip_longest(*wraped_values))
+        self._write(lines, lines.count('\n'))
 
     def write_header(self):
         self.write_line()
         self.write_row((column.label for column in self.columns), True)
         self.write_line()
 
+    @instrument.timed('format')
     def run(self):
         self._compute_widths()
+        self._compile_templates()
         height = self.formatter.height
         last_header_index = 0
 
         index = None
-        for index, data_row in enumerate(self._iter_data_rows()):
-            if (height and self._lines_written >= last_header_index + height) or \
-                    self._lines_written == 0:
-                last_header_index = self._lines_written
-                self.write_header()
-
-            self.write_row(data_row)
-
-        if index is not None:
-            self.write_line()
-        else:
-            self.no_data()
+        try:
+            for index, data_row in enumerate(self._iter_data_rows()):
+                if (height and
+                        self._lines_written >= last_header_index + height) or \
+                        self._lines_written == 0:
+                    last_header_index = self._lines_written
+                    self.write_header()
+
+                self.write_row(data_row)
+
+            if index is not None:
+                self.write_line()
+            else:
+                self.no_data()
+        finally:
+            self.flush()
 
     def no_data(self):
         self.write('no data\n')
@@ -216,6 +242,8 @@ class TableFormatter(object):
     height = None
     width_computation_count = 100
     width_computation_time_limit = .2
+    # Number of writes buffered before writing them to the output
+    buffer_size = 256
 
     def __init__(self):
         self._columns = []
@@ -229,6 +257,10 @@ class TableFormatter(object):
 
         self._columns.append(Column(**kwargs))
 
+    @property
+    def labels(self):
+        return tuple(column.label for column in self._columns)
+
     def write(self, data=None, output=sys.stdout):
         TableFormatterWorker(self, data, output).run()
 
@@ -2,13 +2,24 @@ import hashlib
 import re
 import logging
 
-from .util import create_date, format_date
+from .util import create_date, format_date, parse_date
 
 logger = logging.getLogger(__name__)
 
 
+def compute_hash(account_id, id, type, amount, date, description):
+    chunk = '{}-{}-{}-{}-{}-{}'.format(account_id, id, type, amount, date,
+                                       description).encode('utf-8')
+    sha1 = hashlib.sha1(chunk).hexdigest()
+    # sqlite indexes are on signed 8-bytes integer
+    return int(sha1, 16) % 2 ** 63
+
+
 class Transaction():
 
+    __slots__ = ('account', 'id', 'type', 'amount', 'date', 'description',
+                 '_hash')
+
     def __init__(self, account, date, id, type, amount, description):
         self.account = account
         self.id = int(id)
@@ -18,25 +29,38 @@ class Transaction():
         self.description = re.sub(r'\s+', ' ', description.strip()) \
             .capitalize()
 
+    @classmethod
+    def from_row(cls, account, row):
+        """Create a transaction from a database row, including its hash.
+        Stored transactions are already normalized, so values are used as
+        is."""
+        transaction = cls.__new__(cls)
+        transaction.account = account
+        transaction.id = row['id']
+        transaction.type = row['type']
+        transaction.amount = row['amount']
+        transaction.date = parse_date(row['date'])
+        transaction.description = row['description']
+        transaction._hash = int(row['hash'])
+        return transaction
+
     @property
     def hash(self):
-        chunk = b'-'.join(
-            bytes(str(i), encoding='utf-8') for i in (
-                self.account.id,
-                self.id,
-                self.type,
-                self.amount,
-                format_date(self.date),
-                self.description
-            )
-        )
-        sha1 = hashlib.sha1(chunk).hexdigest()
-        # sqlite indexes are on signed 8-bytes integer
-        return int(sha1, 16) % 2 ** 63
+        try:
+            return self._hash
+        except AttributeError:
+            self._hash = compute_hash(self.account.id,
+                                      self.id,
+                                      self.type,
+                                      self.amount,
+                                      format_date(self.date),
+                                      self.description)
+            return self._hash
 
     def __repr__(self):
-        return 'Transaction({account!r}, {date!r}, {id!r}, {type!r}, {amount!r}, '\
-            '{description!r})'.format(**self.__dict__)
+        return 'Transaction({!r}, {!r}, {!r}, {!r}, {!r}, {!r})'.format(
+            self.account, self.date, self.id, self.type, self.amount,
+            self.description)
 
 
 def tsv_parser(account, lines, create_date=create_date):
@@ -49,3 +73,95 @@ def tsv_parser(account, lines, create_date=create_date):
             continue
         args[0] = create_date(args[0])
         yield Transaction(account, *args)
+
+
+def hash_transactions(transactions):
+    """Compute the hashes of many transactions, like a downloaded file.
+    Transactions are yielded once hashed."""
+    formatted_dates = {}
+
+    for transaction in transactions:
+        date = transaction.date
+        formatted_date = formatted_dates.get(date)
+        if formatted_date is None:
+            formatted_date = formatted_dates[date] = format_date(date)
+
+        transaction._hash = compute_hash(transaction.account.id,
+                                         transaction.id,
+                                         transaction.type,
+                                         transaction.amount,
+                                         formatted_date,
+                                         transaction.description)
+
+        yield transaction
+
+
+if __name__ == '__main__':
+    import datetime
+    import random
+    import time
+
+    class Account():
+        id = '01234567890-000'
+
+    def legacy_hash(transaction):
+        chunk = b'-'.join(
+            bytes(str(i), encoding='utf-8') for i in (
+                transaction.account.id,
+                transaction.id,
+                transaction.type,
+                transaction.amount,
+                format_date(transaction.date),
+                transaction.description
+            )
+        )
+        return int(hashlib.sha1(chunk).hexdigest(), 16) % 2 ** 63
+
+    rnd = random.Random(0)
+    start = datetime.date(2010, 1, 1)
+    lines = [
+        '{}\t{}\t{}\t{:.2f}\t{}'.format(
+            format_date(start + datetime.timedelta(days=index // 100)),
+            index,
+            rnd.choice(('card', 'transfer', 'loan')),
+            rnd.uniform(-1000, 1000),
+            ' '.join(rnd.choice(('paypal', 'amazon', 'sncf', 'rent', 'shop'))
+                     for _ in range(rnd.randint(1, 5))))
+        for index in range(500000)
+    ]
+
+    account = Account()
+
+    def parse():
+        return tsv_parser(account, lines, create_date=parse_date)
+
+    def bench(label, function):
+        start = time.time()
+        for _ in function():
+            pass
+        duration = time.time() - start
+        print('{:<20} {:>10.0f} rows/s'.format(label, len(lines) / duration))
+
+    def legacy():
+        # The hash was computed on every access: once to store the
+        # transaction, once more to deduplicate it
+        for transaction in parse():
+            legacy_hash(transaction)
+            yield legacy_hash(transaction)
+
+    def cached():
+        for transaction in parse():
+            transaction.hash
+            yield transaction.hash
+
+    def batched():
+        for transaction in hash_transactions(parse()):
+            transaction.hash
+            yield transaction.hash
+
+    for transaction in hash_transactions(parse()):
+        assert legacy_hash(transaction) == transaction.hash
+
+    bench('legacy', legacy)
+    bench('cached', cached)
+    bench('hash_transactions', batched)
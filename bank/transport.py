@@ -0,0 +1,180 @@
+"""HTTP transport of adaptor sessions, configured in the `sessions` block.
+
+Any `requests` session returned by an adaptor gets a transport adapter with
+a bounded connection pool, connect and read timeouts, and retries with an
+exponential backoff. Sessions are shared by the accounts using them, so
+connections are kept alive and reused from one account to the next.
+"""
+import collections
+
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+# Settings of a session configuration, and their default values
+defaults = collections.OrderedDict((
+    ('pool_size', 4),           # connections kept alive by host
+    ('keep_alive', True),
+    ('connect_timeout', 10),    # in seconds
+    ('read_timeout', 60),       # in seconds
+    ('retries', 3),
+    ('retry_backoff', 0.5),     # in seconds, factor of exponential delays
+    ('gzip', True),
+))
+
+# Idempotent requests answered by these statuses are retried
+retry_statuses = (500, 502, 503, 504)
+
+
+class TransportAdapter(HTTPAdapter):
+    """HTTP adapter applying a default timeout to requests."""
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+def get_options(config):
+    return collections.OrderedDict(
+        (name, config.get(name, default))
+        for name, default in defaults.items())
+
+
+def adapter_arguments(options):
+    """Return the keyword arguments of a `TransportAdapter`."""
+    return {
+        'timeout': (options['connect_timeout'], options['read_timeout']),
+        'pool_maxsize': options['pool_size'],
+        'max_retries': Retry(total=options['retries'],
+                             backoff_factor=options['retry_backoff'],
+                             status_forcelist=retry_statuses,
+                             raise_on_status=False),
+    }
+
+
+def configure(session, config, cache_path=None):
+    """Mount a transport adapter configured by a session configuration on a
+    requests session. Responses are cached in the `cache_path` directory if
+    the configuration has a `cache_ttl`."""
+    options = get_options(config)
+    arguments = adapter_arguments(options)
+
+    # Missing settings are empty configs
+    cache_ttl = config.cache_ttl
+    if isinstance(cache_ttl, (int, float)):
+        from .httpcache import CachingAdapter
+        adapter = CachingAdapter(cache_path, cache_ttl, **arguments)
+    else:
+        adapter = TransportAdapter(**arguments)
+
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    if not options['keep_alive']:
+        session.headers['Connection'] = 'close'
+
+    if not options['gzip']:
+        session.headers['Accept-Encoding'] = 'identity'
+
+    return adapter
+
+
+if __name__ == '__main__':
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import threading
+    import time
+
+    import requests
+
+    from bank.config import Config
+
+    requests_headers = []
+    client_ports = set()
+    failures = collections.Counter()
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+        def handle_error(self, request, client_address):
+            # Timed out clients are gone when the answer is sent
+            pass
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            requests_headers.append(self.headers)
+            client_ports.add(self.client_address[1])
+
+            if self.path.startswith('/slow'):
+                time.sleep(0.5)
+
+            if self.path.startswith('/flaky') and failures[self.path] < 2:
+                failures[self.path] += 1
+                status = 503
+            else:
+                status = 200
+
+            self.send_response(status)
+            self.send_header('Content-Length', '3')
+            self.end_headers()
+            self.wfile.write(b'ok\n')
+
+        do_POST = do_GET
+
+        def log_message(self, *args):
+            pass
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    root = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    def create_session(config):
+        session = requests.Session()
+        configure(session, Config(config))
+        return session
+
+    # Defaults
+    options = get_options(Config(None))
+    assert options == defaults
+
+    # Connections are kept alive
+    session = create_session({})
+    for _ in range(3):
+        session.get(root + '/')
+    assert len(client_ports) == 1
+    assert 'gzip' in requests_headers[-1]['Accept-Encoding']
+
+    session = create_session({'keep_alive': False, 'gzip': False})
+    for _ in range(2):
+        session.get(root + '/')
+    assert len(client_ports) == 3
+    assert requests_headers[-1]['Accept-Encoding'] == 'identity'
+
+    # Failed requests are retried, up to a limit
+    session = create_session({'retry_backoff': 0})
+    assert session.get(root + '/flaky1').status_code == 200
+    session = create_session({'retries': 1, 'retry_backoff': 0})
+    assert session.get(root + '/flaky2').status_code == 503
+
+    # But not requests which may not be idempotent
+    session = create_session({'retry_backoff': 0})
+    assert session.post(root + '/flaky3').status_code == 503
+
+    # Stalled requests time out, reported once retries are exhausted
+    session = create_session({'read_timeout': 0.1, 'retries': 1})
+    try:
+        session.get(root + '/slow')
+    except requests.exceptions.ConnectionError:
+        pass
+    else:
+        assert False, 'request should time out'
+    assert session.get(root + '/slow', timeout=2).status_code == 200
+
+    server.shutdown()
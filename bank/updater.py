@@ -0,0 +1,201 @@
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+from .account import TransactionWriter
+from .util import chunks
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateStopped(Exception):
+    pass
+
+
+class AccountUpdate(object):
+
+    def __init__(self, account):
+        self.account = account
+        self.balance_before = account.get_balance()
+        self.since = account.update_since()
+        self.writer = TransactionWriter(account, since=self.since)
+        self.fetch_time = 0
+        self.store_time = 0
+        self.error = None
+        self.finished = False
+
+    @property
+    def total_time(self):
+        return self.fetch_time + self.store_time
+
+
+def group_by_session(accounts):
+    groups = collections.OrderedDict()
+    for account in accounts:
+        groups.setdefault(account.adaptor.session_key, []).append(account)
+    return tuple(groups.values())
+
+
+class Updater(object):
+    """Update accounts balances and transactions.
+
+    Accounts are grouped by adaptor session: accounts of a same group are
+    fetched one after the other, but up to `jobs` groups are fetched
+    concurrently. Every database write is done by the thread calling `run`,
+    so the database connection is never shared between threads.
+
+    An account whose transactions can't be stored is reported as failed, like
+    when they can't be fetched. If the update is interrupted, fetching threads
+    are stopped and the transactions of the accounts not done are rolled back
+    before the interruption is raised again.
+    """
+
+    def __init__(self, accounts, jobs=1, echo=print):
+        self.accounts = accounts
+        self.jobs = jobs
+        self.echo = echo
+        self.updates = collections.OrderedDict()
+        self._queue = queue.Queue(maxsize=max(jobs, 1) * 2)
+        self._stopped = threading.Event()
+
+    def run(self):
+        for account in self.accounts:
+            self.updates[account] = AccountUpdate(account)
+            # Create sessions beforehand, since it may prompt for credentials
+            account.adaptor.session
+
+        groups = group_by_session(self.accounts)
+
+        if self.jobs <= 1:
+            for group in groups:
+                for account in group:
+                    self._update_account(account, self._store)
+        else:
+            self._run_concurrently(groups)
+
+        return tuple(self.updates.values())
+
+    def _run_concurrently(self, groups):
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+            pending = len(groups)
+            for group in groups:
+                executor.submit(self._update_group, group)
+
+            try:
+                while pending:
+                    action, account, args = self._queue.get()
+                    if action is None:
+                        pending -= 1
+                    else:
+                        self._store(action, account, args)
+            except BaseException as e:
+                # Threads may be blocked on the full queue: drain it until
+                # they all stopped
+                self._stopped.set()
+                while pending:
+                    action, _, _ = self._queue.get()
+                    if action is None:
+                        pending -= 1
+
+                # Their last actions were dropped: remove what the accounts
+                # not done stored, which other accounts may have committed
+                for update in self.updates.values():
+                    if not update.finished:
+                        update.error = update.error or e
+                        update.writer.rollback()
+                raise
+
+    def _update_group(self, group):
+        try:
+            for account in group:
+                if self._stopped.is_set():
+                    break
+                self._update_account(account, self._enqueue)
+        finally:
+            self._queue.put((None, None, None))
+
+    def _enqueue(self, action, account, args):
+        self._queue.put((action, account, args))
+
+    def _update_account(self, account, store):
+        update = self.updates[account]
+        start = time.time()
+        waiting = 0
+
+        def send(action, args):
+            nonlocal waiting
+            if self._stopped.is_set():
+                raise UpdateStopped('update interrupted')
+            send_start = time.time()
+            store(action, account, args)
+            waiting += time.time() - send_start
+
+        try:
+            send('balance', account.adaptor.fetch_balance())
+
+            for chunk in chunks(
+                    account.adaptor.fetch_transactions(update.since),
+                    TransactionWriter.chunk_size):
+                send('transactions', chunk)
+        except Exception as e:
+            logger.exception('Failed to fetch account %s', account.name)
+            update.error = e
+        except BaseException as e:
+            # Interrupted: what was fetched is rolled back when done
+            update.error = e
+            raise
+        finally:
+            update.fetch_time = time.time() - start - waiting
+            store('done', account, None)
+
+    def _store(self, action, account, args):
+        update = self.updates[account]
+        start = time.time()
+
+        try:
+            # Once an account failed, only its end is handled
+            if update.error is None or action == 'done':
+                self._store_action(update, action, args)
+        except Exception as e:
+            logger.exception('Failed to store account %s', account.name)
+            update.error = e
+
+        update.store_time += time.time() - start
+
+        if action == 'done':
+            update.finished = True
+            self.report(update)
+
+    def _store_action(self, update, action, args):
+        if action == 'balance':
+            update.account.store_balance(*args)
+
+        elif action == 'transactions':
+            update.writer.write(args)
+
+        elif action == 'done':
+            # A partial download may leave holes, which the next update
+            # won't fill since it starts from the last stored date
+            if update.error is None:
+                update.writer.close()
+            else:
+                update.writer.rollback()
+
+    def report(self, update):
+        account = update.account
+        self.echo('Udpating account {}'.format(account.name))
+
+        if update.error:
+            self.echo('Error: {}'.format(str(update.error) or
+                                         type(update.error).__name__))
+            return
+
+        self.echo('Balance diff: {:.2}'
+                  .format(account.get_balance() - update.balance_before))
+
+        writer = update.writer
+        self.echo('{} new transactions ({} unchanged, {} vanished)'
+                  .format(writer.new, writer.unchanged, writer.vanished))
@@ -1,10 +1,11 @@
 import re
+import contextlib
 import datetime
-import collections
+import itertools
 import json
+import os
 
-import yaml
-import dateutil.parser
+from .balance import sum_by_buckets
 
 
 def json_default(o):
@@ -13,21 +14,30 @@ def json_default(o):
     return json.JSONEncoder.default(o)
 
 
-class YamlDumper(yaml.SafeDumper):
-    pass
-
-
-YamlDumper.add_representer(
-    collections.OrderedDict,
-    lambda r, d: YamlDumper.represent_dict(r, d.items()))
-
-
-class YamlLoader(yaml.SafeLoader):
-    pass
-
-YamlLoader.add_constructor(
-    YamlLoader.DEFAULT_MAPPING_TAG,
-    lambda loader, node: collections.OrderedDict(loader.construct_pairs(node)))
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = tuple(itertools.islice(iterator, size))
+        if not chunk:
+            break
+        yield chunk
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    """Open a file replacing `path` once written. Temporary files have unique
+    names, so concurrent processes don't clobber each other, and are only
+    readable by their owner."""
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, **kwargs) as fp:
+            yield fp
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
 
 
 def generate_dates(start, delta):
@@ -44,6 +54,8 @@ def create_date(date=None, **parser_options):
         date = datetime.date.today()
 
     elif isinstance(date, str):
+        # dateutil is slow to import, and only needed to parse user input
+        import dateutil.parser
         date = dateutil.parser.parse(date, **parser_options).date()
 
     elif not isinstance(date, datetime.date):
@@ -56,22 +68,50 @@ def format_date(date):
     return date.strftime('%Y-%m-%d')
 
 
-def format_serie(account, since, delta):
-    labels = []
-    values = []
+def create_cursor(value):
+    """Parse a `DATE,HASH` search cursor, as printed after a page of search
+    results."""
+    date, _, hash = value.rpartition(',')
+    parse_date(date)
+    if not hash.isdigit():
+        raise ValueError('not a transaction hash {!r}'.format(hash))
+    return date, hash
+
 
-    balance = account.get_balance(since=since)
-    for date, transactions in account.iter_transactions_by_dates(
-            since=since,
-            delta=delta,
-            until=create_date()):
-        balance += sum(t.amount for t in transactions)
-        label = '{} ({})'.format(date.strftime('%d-%m-%y'), len(transactions))
-        value = round(balance, 2)
-        values.append(value)
-        labels.append(label)
+# Parse a date formatted by `format_date`
+try:
+    parse_date = datetime.date.fromisoformat
+except AttributeError:  # python < 3.7
+    def parse_date(date):
+        return datetime.date(int(date[:4]), int(date[5:7]), int(date[8:10]))
 
-    return labels, values
+
+def format_series(accounts, since, delta):
+    until = create_date()
+    dates = tuple(itertools.takewhile(lambda date: date < until,
+                                      generate_dates(since, delta)))
+
+    sums = sum_by_buckets(accounts[0].db.cursor() if accounts else None,
+                          tuple(account.id for account in accounts),
+                          tuple(format_date(date) for date in dates))
+
+    labels = [
+        '{} ({})'.format(date.strftime('%d-%m-%y'),
+                         sum(sums.get((account.id, index), (0, 0))[1]
+                             for account in accounts))
+        for index, date in enumerate(dates)
+    ]
+
+    series = []
+    for account in accounts:
+        balance = account.get_balance(since=since)
+        values = []
+        for index in range(len(dates)):
+            balance += sums.get((account.id, index), (0, 0))[0]
+            values.append(round(balance, 2))
+        series.append(values)
+
+    return labels, series
 
 
 delta_re = re.compile(r'''
@@ -82,6 +122,8 @@ delta_re = re.compile(r'''
 
 
 def create_delta(delta):
+    import dateutil.relativedelta
+
     if isinstance(delta, str):
 
         args = {}
@@ -0,0 +1,43 @@
+"""YAML loading and dumping, preserving mappings order.
+
+Imported only when a configuration file has to be parsed or dumped, since
+`yaml` is slow to import.
+"""
+import collections
+
+import yaml
+
+from .config import Config
+
+# The libyaml based loader is much faster, when available
+SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+class YamlDumper(yaml.SafeDumper):
+    pass
+
+
+YamlDumper.add_representer(
+    collections.OrderedDict,
+    lambda r, d: YamlDumper.represent_dict(r, d.items()))
+
+YamlDumper.add_representer(
+    Config,
+    lambda r, c: YamlDumper.represent_dict(r, c._config))
+
+
+class YamlLoader(SafeLoader):
+    pass
+
+
+YamlLoader.add_constructor(
+    YamlLoader.DEFAULT_MAPPING_TAG,
+    lambda loader, node: collections.OrderedDict(loader.construct_pairs(node)))
+
+
+def load(fp):
+    return yaml.load(fp, YamlLoader)
+
+
+def dump(data):
+    return yaml.dump(data, Dumper=YamlDumper)
@@ -24,11 +24,13 @@ setup(name='bank',
       install_requires=[
           'python-dateutil >=2.2,<3',
           'click >=3,<4',
-          'requests >=2.3,<3',
+          'requests >=2.10,<3',
           'pyyaml >=3.11,<4',
-          'pyPEG2 >=2.15.0,<3',
           'pygal >=1.5.1,<2',
       ],
+      extras_require={
+          'sessions': ['cryptography'],
+      },
       entry_points={
           'console_scripts': ['bank=bank.__main__:main'],
       },